@@ -13,22 +13,37 @@
 只需部署一个
 必须与数据库，日志提取程序，日志分析程序部署在同一网络下
 
-命令格式：   cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password>
+命令格式：   cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--change_stream] [--refresh_only]
 示例命令：   nohup python3 cleaner.py --db_ip xxx.xxx.xxx.xxx --db_user admin --db_password xxxxxxxx &
+
+加上--change_stream时使用推送模式（数据库需为副本集部署，单节点副本集即可），新日志到达后立即更新，否则每3秒轮询一次
+加上--refresh_only时只刷新数据并发布到本地文件，接口由uWSGI的多个工作进程提供（见cleaner_wsgi.py）
 '''
 
 import getopt, sys
 import threading
+import queue
 import time, json
 import datetime
+import gzip
+import base64
+import bisect
+import heapq
+import hashlib
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 import ast
 import demjson
 import logging
 
 # 数据库连接类
 from connect_class import db_connect
+# 异常日志缓冲类
+from connect_class import error_buffer
+# 内存状态快照类
+from connect_class import state_snapshot
 
 # 设置日志格式，等级等
 LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s %(pathname)s %(message)s "  # 配置输出日志格式
@@ -42,13 +57,32 @@ logging.basicConfig(level=logging.DEBUG,
 # 全局变量
 INIT_TIME = time.time()
 DETAIL = []
-DETAIL_ERROR = []
+DETAIL_ERROR = error_buffer.ErrorBuffer()  # 异常日志（按列存储，按时间排序）
 SOURCE_STATUS = []
 STATISTICS_ERROR = {}
 STATISTICS_WARN = {}
 STATISTICS_NORMAL = {}
 ANALYSE_DATA = {}
 HEALTH = {}
+DETAIL_BY_SOURCE = {}  # (节点名, 日志来源) -> 该来源的最新100条日志
+STATISTICS_BY_SOURCE = {}  # (节点名, 日志来源) -> {'statistics error': [...], 'statistics warn': [...], 'statistics normal': [...]}
+WARMUP_CUTOFFS = {}  # 节点名 -> 预热截止时间（collector初始化时间之后两秒），此前的日志不参与分析
+RESPONSES = {}  # 接口名 -> 每轮刷新后预先生成的响应：{'etag': 内容摘要, 'body': JSON字节, 'gzip': 压缩后的JSON字节}
+# 分页查询用的索引，(节点名, 日志来源)或None（所有来源） -> 按键升序排列的(数据列表, 键列表)
+DETAIL_PAGES = {}  # 键为(时间, 日志id)
+STATISTICS_PAGES = {}  # 值为{'statistics error': (数据列表, 键列表), ...}，键为(小时, 节点名, 日志来源)
+
+# 分页查询每页的默认条数和最大条数
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+PAGE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'  # since、until的时间格式
+CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+HOUR_FORMAT = '%Y-%m-%d-%H'  # 统计数据的小时格式
+STATISTICS_NAMES = ['statistics error', 'statistics warn', 'statistics normal']
+
+# 多进程部署（见cleaner_wsgi.py）时，刷新进程发布接口数据的快照文件地址，各接口进程共用的分析数据文件地址
+SHARED_STATE_PATH = r'/var/lib/cleaner/shared_state.bin'
+ANALYSE_DATA_PATH = r'/var/lib/cleaner/analyse_data.bin'
 
 # ------------------------------------------辅助类------------------------------------------
 # *******************************************************************************************
@@ -63,37 +97,237 @@ class DateEncoder(json.JSONEncoder):
             return json.JSONEncoder.default(self, obj)
 
 
+# 生成接口的缓存响应（JSON序列化、计算ETag并压缩），内容与上次相同时沿用上次的响应，不再压缩
+def build_response(name, return_dict):
+    body = json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False).encode('utf-8')
+    etag = hashlib.md5(body).hexdigest()
+    cached = RESPONSES.get(name)
+    if cached is not None and cached['etag'] == etag:
+        return cached
+    return {'etag': etag, 'body': body, 'gzip': gzip.compress(body)}
+
+
+# 返回接口的缓存响应：请求的If-None-Match与ETag相同时返回304，客户端支持gzip时返回压缩后的内容
+# 多进程部署时刷新进程尚未发布数据的，返回503
+def cached_response(name):
+    cached = RESPONSES.get(name)
+    if cached is None:
+        return Response(status=503)
+    if request.if_none_match.contains(cached['etag']):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(cached['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(cached['body'], mimetype='application/json')
+    response.set_etag(cached['etag'])
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+# 将数据列表按键升序排列，返回值为(数据列表, 键列表)，fields为组成键的字段
+def sorted_page(data_list, fields):
+    data_list = sorted(data_list, key=lambda i: tuple(i[field] for field in fields))
+    return data_list, [tuple(data[field] for field in fields) for data in data_list]
+
+
+# 合并多个已按键升序排列的(数据列表, 键列表)，不必重新排序
+def merge_pages(pages):
+    merged = list(heapq.merge(*[zip(keys, data_list) for data_list, keys in pages], key=lambda i: i[0]))
+    return [item[1] for item in merged], [item[0] for item in merged]
+
+
+# 一个日志来源的分页索引，返回值为(明细的索引, {统计名: 统计的索引})
+def source_pages(detail, statistics):
+    return sorted_page(detail, ['time', 'log id']), \
+        {name: sorted_page(statistics[name], ['time', 'machine', 'source']) for name in STATISTICS_NAMES}
+
+
+# 由按(节点名, 日志来源)的索引生成分页查询用的索引，返回值为(DETAIL_PAGES, STATISTICS_PAGES)
+# pages为已生成的各日志来源的索引（见source_pages），不在其中的日志来源重新生成
+def build_pages(detail_by_source, statistics_by_source, pages=None):
+    pages = pages or {}
+    detail_pages = {}
+    statistics_pages = {}
+    for key in detail_by_source:
+        if key not in pages:
+            pages[key] = source_pages(detail_by_source[key], statistics_by_source[key])
+        detail_pages[key], statistics_pages[key] = pages[key]
+    detail_pages[None] = merge_pages([detail_pages[key] for key in detail_by_source])
+    statistics_pages[None] = {name: merge_pages([statistics_pages[key][name] for key in statistics_by_source])
+                              for name in STATISTICS_NAMES}
+    return detail_pages, statistics_pages
+
+
+# 分页：pages为按键升序排列的(数据列表, 键列表)的列表，键的第一项为时间
+# 取键的时间在[since, until)内、键小于cursor的最新的limit条数据，按时间倒序排列
+# 多个列表时各列表以同一个键为分页边界，返回值为(各列表的一页数据, 下一页的cursor键，没有下一页时为None)
+def page_lists(pages, since, until, cursor, limit):
+    ranges = []
+    boundary = None
+    for data_list, keys in pages:
+        start = 0 if since is None else bisect.bisect_left(keys, (since,))
+        end = len(keys) if until is None else bisect.bisect_left(keys, (until,))
+        if cursor is not None:
+            end = min(end, bisect.bisect_left(keys, cursor))
+        page_start = max(start, end - limit)
+        if page_start > start and (boundary is None or keys[page_start] > boundary):
+            boundary = keys[page_start]
+        ranges.append((data_list, keys, page_start, end))
+    return_list = []
+    for data_list, keys, page_start, end in ranges:
+        if boundary is not None:
+            page_start = max(page_start, bisect.bisect_left(keys, boundary))
+        return_list.append(data_list[page_start:end][::-1])
+    return return_list, boundary
+
+
+# 将分页的键编码为cursor字符串
+def encode_cursor(key):
+    if key is None:
+        return None
+    values = [value.strftime(CURSOR_TIME_FORMAT) if isinstance(value, datetime.datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+# 将cursor字符串解码为分页的键，time_key为键的第一项是否为时间，cursor格式错误时抛出ValueError
+def decode_cursor(cursor, time_key=True):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor).encode('ascii')).decode('utf-8'))
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            raise ValueError
+        if time_key:
+            values[0] = datetime.datetime.strptime(values[0], CURSOR_TIME_FORMAT)
+        return tuple(values)
+    except (ValueError, TypeError, LookupError):
+        raise ValueError('invalid cursor: %s' % cursor)
+
+
+# 读取请求参数：请求体中的JSON和URL中的查询参数（同名时以查询参数为准）
+def request_params(request_data):
+    params = {}
+    if request_data != b'':
+        params.update(demjson.decode(request_data))
+    params.update(request.args.to_dict())
+    return params
+
+
+# 读取分页参数：since、until（格式为PAGE_TIME_FORMAT），limit（不超过MAX_PAGE_SIZE），cursor（上一页返回的next cursor）
+# 没有分页参数时返回None，参数格式错误时抛出ValueError
+def page_params(params, time_key=True):
+    if not any(name in params for name in ('since', 'until', 'limit', 'cursor')):
+        return None
+    page = {'since': None, 'until': None, 'limit': DEFAULT_PAGE_SIZE, 'cursor': None}
+    try:
+        for name in ('since', 'until'):
+            if params.get(name):
+                page[name] = datetime.datetime.strptime(str(params[name]), PAGE_TIME_FORMAT)
+        if params.get('limit'):
+            page['limit'] = min(max(int(params['limit']), 1), MAX_PAGE_SIZE)
+    except (ValueError, TypeError):
+        raise ValueError('since and until should be like 2020-08-17 07:00:00, limit should be an integer')
+    if params.get('cursor'):
+        page['cursor'] = decode_cursor(params['cursor'], time_key)
+    return page
+
+
+# 读取日志来源参数machine、source，返回值为(machine, source)，都没有时返回None
+# 只有其中一个或不是字符串时抛出ValueError
+def source_key(params):
+    if 'machine' not in params and 'source' not in params:
+        return None
+    if not isinstance(params.get('machine'), str) or not isinstance(params.get('source'), str):
+        raise ValueError('machine and source should be given together as strings')
+    return params['machine'], params['source']
+
+
+# 分页参数格式错误时的响应
+def param_error(e):
+    return json.dumps({'msg': '参数格式错误: %s' % e}, ensure_ascii=False), 400
+
+
 # 查询具体日志条目（辅助LocalAPI类）
+# 各节点并行查询，每个日志来源只查询一次（按日志id批量查询）
 class GetDataFromMongoDB:
-    def __init__(self, db_ip, db_user, db_password):
+    def __init__(self, db_ip, db_user, db_password, workers=8):
         print('GetDataFromMongoDB init')
         self.params = {}
         self.params['db_ip'] = db_ip
         self.params['db_user'] = db_user
         self.params['db_password'] = db_password
+        self.pool = ThreadPoolExecutor(max_workers=workers)  # 并行查询各节点的线程池
 
-    # 获取具体日志条目
+    # 以流的形式获取具体日志条目，返回值为JSON文本片段的生成器
     # 请求：{"machine": {"source":[id1, id2]}}
-    # 返回值：{"machine": {"source":{"id": "data"}}}
-    def get_data(self, get_data_input):
-        get_data_output = {}
-        if get_data_input:
-            for machine in get_data_input:
-                get_data_output[machine] = {}
-                for source in get_data_input[machine]:
-                    get_data_output[machine][source] = \
-                        self.get_data_from_database(machine, source, get_data_input[machine][source])
-            print('=========================')
-            print('GetDataFromMongoDB finish')
-            return get_data_output
-
-    def get_data_from_database(self, db_name, col_name, id_list):
+    # 拼接后的返回值：{"machine": {"source":{"id": "data"}}}
+    # 各节点并行查询，按请求中的顺序逐个节点输出，不必等待所有节点查询完毕
+    # 响应头已发出，某个节点查询失败时该节点输出{"error": 错误信息}，保证输出的JSON完整
+    def stream_data(self, get_data_input):
+        if not get_data_input:
+            yield 'null'
+            return
+        machines = list(get_data_input)
+        tasks = [self.pool.submit(self.get_machine_data, machine, get_data_input[machine]) for machine in machines]
+        yield '{'
+        for seq in range(len(machines)):
+            if seq:
+                yield ', '
+            try:
+                machine_output = tasks[seq].result()
+            except Exception as e:
+                print('request data of %s failed: %s' % (machines[seq], e))
+                logging.warning('request data of %s failed: %s' % (machines[seq], e))
+                machine_output = {'error': str(e)}
+            yield '%s: %s' % (json.dumps(machines[seq], ensure_ascii=False),
+                              json.dumps(machine_output, cls=DateEncoder, ensure_ascii=False))
+        yield '}'
+
+    # 从汇总表读取一个日志来源按granularity（见db_connect.ROLLUP_COLLECTIONS）的统计，只包含汇总表建立之后写入的日志
+    # since、until为datetime（为None时不限制），返回与request_statistics格式相同的三类统计，每类按时间倒序最多limit条
+    def get_rollup_statistics(self, key, granularity, since=None, until=None, limit=None):
+        time_format = db_connect.ROLLUP_COLLECTIONS[granularity][1]
+        if since is not None:
+            since = since.strftime(time_format)
+        # until所在的时间段与[since, until)有重叠时包含该时间段
+        if until is not None:
+            until = (until - datetime.timedelta(microseconds=1)).strftime(time_format)
+        conn = db_connect.DataBase(key[0], self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'])
+        statistics = {0: {}, 1: {}, 2: {}}
+        for data in conn._request_rollup(key[1], granularity, since=since, until=until):
+            counter = statistics[GetStatisticsFromMongoDB.statistics_class(data['_id']['urgent class'])]
+            counter[data['_id']['date']] = counter.get(data['_id']['date'], 0) + data['count']
         return_dict = {}
+        for name, urgent_class in zip(STATISTICS_NAMES, (2, 1, 0)):
+            return_dict[name] = GetStatisticsFromMongoDB.statistics_list(key, statistics[urgent_class])[:limit]
+        return return_dict
+
+    # 获取一个节点中各日志来源的具体日志条目
+    # 请求：{"source":[id1, id2]}，返回值：{"source":{"id": "data"}}
+    def get_machine_data(self, db_name, source_dict):
         conn = db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
                                    self.params['db_ip'])
-        request_dict = conn._request(col_name, id_list)
-        for seq in range(len(request_dict)):
-            return_dict[request_dict[seq]['log id']] = request_dict[seq]['data']
+        col_names = conn.get_col_names()
+        machine_output = {}
+        for col_name in source_dict:
+            machine_output[col_name] = self.get_data_from_database(db_name, col_name, source_dict[col_name], col_names)
+        return machine_output
+
+    # 获取一个日志来源的具体日志条目，col_names为该节点的表名列表（为None时自动查询）
+    def get_data_from_database(self, db_name, col_name, id_list, col_names=None):
+        return_dict = {}
+        conn = db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'])
+        # 日志来源存储在合并表中
+        if col_names is None:
+            consolidated = conn.is_consolidated(col_name)
+        else:
+            consolidated = col_name not in col_names and db_connect.CONSOLIDATED_COLLECTION in col_names
+        if consolidated:
+            conn = db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
+                                       self.params['db_ip'], consolidated=1)
+        for data in conn._iter_request(col_name, id_list):
+            return_dict[data['log id']] = data['data']
         return return_dict
 
     # 获取所有数据库的初始化时间
@@ -107,121 +341,966 @@ class GetDataFromMongoDB:
 # *******************************************************************************************
 
 # 从mongodb数据库中定时提取日志
+# 每张表记录已读取的最大_id（高水位），每轮只查询新增的日志，合并到内存中的数据并增量更新统计
+# 推送模式下，通过change stream接收数据库推送的新日志，轮询仅作为补充
+# 节点使用合并表存储时，每轮对该节点只查询一次新日志和汇总表，再按来源分别合并
+# 各节点的查询在线程池中并行执行，一轮轮询的耗时取决于最慢的节点，而不是所有节点耗时之和
 class GetStatisticsFromMongoDB(threading.Thread):
-    # 初始化参数： 本机名，数据库ip，数据库用户，数据库密码，自定义日志位置， 告警判断选项，告警规则，
-    def __init__(self, db_ip, db_user, db_password, threadLock):
+    # 初始化参数：数据库ip，数据库用户，数据库密码，线程锁，
+    # 全量刷新的时间间隔（秒，用于补上数据库恢复后collector补传的、_id小于高水位的旧日志，为0时不全量刷新），
+    # 推送事件队列（为None时使用轮询模式），推送模式下的轮询间隔（秒），在内存中按时间排序保存的异常日志条数上限，
+    # 并行查询节点的线程数，每轮等待节点查询完成的最长时间（秒），内存状态快照（StateSnapshot，为None时不使用），
+    # 多进程部署时发布接口数据的快照（StateSnapshot，为None时不发布），推送模式下两次发布的最短间隔（秒）
+    def __init__(self, db_ip, db_user, db_password, threadLock, full_interval=3600, events=None, poll_interval=60,
+                 error_buffer_size=100000, refresh_workers=16, node_timeout=5, snapshot=None, publisher=None,
+                 publish_interval=0.2):
         threading.Thread.__init__(self)
         self.params = {}
         # 数据库连接参数
         self.params['db_ip'] = db_ip
         self.params['db_user'] = db_user
         self.params['db_password'] = db_password
-        # 数据库名，表名
+        # 数据库名 -> {表名（合并存储时为日志来源）: 是否存储在合并表中}
         self.db_content = {}
+        self.layouts = {}  # (数据库名, 表名) -> 是否存储在合并表中
+        self.node_marks = {}  # 数据库名 -> 合并表的高水位
         self.threadLock = threadLock
+        # 每张表的内存数据：(数据库名, 表名) -> {'mark': 高水位, 'detail': 最新100条日志, 'status': 最新一条日志,
+        # 'errors': 故障日志（ErrorBuffer）, 'statistics': {告警级别: {小时: 条数}}, 'bucket': 已读取的汇总表中最新的小时,
+        # 'rollup start': 汇总表中最早的小时（升级时所在的小时，该小时的计数不以汇总表为准）}
+        self.sources = {}
+        self.full_interval = full_interval
+        self.last_full = time.time()
+        self.events = events
+        self.poll_interval = poll_interval
+        self.error_buffer_size = error_buffer_size
+        self.init_time_mark = 0  # 已读取的初始化时间的变动标记
+        self.replay_mark = 0  # 已读取的补传标注的起点（0表示尚未读取）
+        self.replays = {}  # 有日志补传的(数据库名, 表名) -> 需要重新查询的最小_id
+        self.reloading = set()  # 需要重新加载的(数据库名, 表名)，重新加载前沿用原有数据
+        self.reloading_nodes = set()  # 需要整体重新加载的数据库名，重新加载的结果合并时才重置合并表的高水位
+        self.pool = ThreadPoolExecutor(max_workers=refresh_workers)  # 并行查询节点的线程池
+        self.node_timeout = node_timeout
+        self.pending = {}  # 数据库名 -> 尚未合并的节点查询（Future）
+        self.snapshot = snapshot
+        self.publisher = publisher
+        self.published_etags = None  # 上次发布的各接口响应的ETag
+        self.published_cutoffs = None  # 上次发布的预热截止时间
+        self.publish_interval = publish_interval
+        self.last_publish = 0  # 上次发布的时间
+        self.views = {}  # 已生成的各表的统计列表和分页索引：(数据库名, 表名) -> {'statistics': ..., 'pages': ...}
+        # 有快照时从快照恢复，接口在首轮轮询完成前即可返回重启前的数据
+        if self.snapshot is not None:
+            self.restore_snapshot()
+        # 生成初始的缓存响应
+        self.publish(True, [])
 
     # 数据库监控主函数
     def run(self):
-        global DETAIL, DETAIL_ERROR, SOURCE_STATUS, STATISTICS_ERROR, STATISTICS_WARN, STATISTICS_NORMAL
         while 1:
             start_time = time.time()
-            # 更新数据库和数据表信息
-            self.db_content = self.check_db_and_col_names()
-            # 获取detail表和statistics表的信息
-            temp_detail = []
-            temp_detail_error = []
-            temp_source_status = []
-            temp_statistics_error = []
-            temp_statistics_warn = []
-            temp_statistics_normal = []
-            for db_name in self.db_content:
-                if db_name != 'init_time':
-                    for col_name in self.db_content[db_name]:
-                        for data in self.get_detail(db_name, col_name):
-                            temp_detail.append(data)
-                        for data in self.get_detail(db_name, col_name, limit=1):
-                            del data['log id']
-                            temp_source_status.append(data)
-                        for data in self.get_detail(db_name, col_name, urgent_class=2, limit=-1):
-                            temp_detail_error.append(data)
-                        s_error, s_warn, s_normal = self.get_statistics(db_name, col_name)
-                        if s_error:
-                            for i in s_error:
-                                temp_statistics_error.append(i)
-                        if s_warn:
-                            for i in s_warn:
-                                temp_statistics_warn.append(i)
-                        if s_normal:
-                            for i in s_normal:
-                                temp_statistics_normal.append(i)
-            # 将结果保存在全局变量中，方便api类调用
-            self.threadLock.acquire()
-            DETAIL = temp_detail
+            self.refresh()
+            self.save_snapshot()
+            # 推送模式：在下次轮询前持续接收推送的新日志
+            if self.events is not None:
+                self.wait_events(start_time + self.poll_interval)
+            else:
+                while time.time() - start_time < 3:
+                    time.sleep(1)
+
+    # 轮询一次所有节点：各节点的查询在线程池中并行执行，查询结果在本线程中依次合并
+    # 超过node_timeout仍未完成查询的节点沿用上次的数据，查询完成后在之后的轮询中合并，期间不重复提交
+    def refresh(self):
+        self.refresh_init_time()
+        self.refresh_replays()
+        # 到达全量刷新时间时，所有节点重新加载，各节点的重新加载结果合并前沿用原有数据
+        if self.full_interval and time.time() - self.last_full >= self.full_interval:
+            self.last_full = time.time()
+            for db_name in set(key[0] for key in self.sources) | set(self.node_marks):
+                self.reload_node(db_name)
+        # 获取数据库名（即节点名称），提交各节点的查询
+        db_names = self.check_db_names()
+        for db_name in db_names:
+            if db_name not in self.pending:
+                self.pending[db_name] = self.pool.submit(self.fetch_node, db_name, *self.node_state(db_name))
+        futures.wait(list(self.pending.values()), timeout=self.node_timeout)
+        # 合并已完成查询的节点
+        rebuild_error = False  # 故障日志是否需要整体重建
+        new_error = []
+        timings = {}
+        for db_name in list(self.pending):
+            if not self.pending[db_name].done():
+                print('node %s is slow, serving its last data' % db_name)
+                continue
+            try:
+                result = self.pending.pop(db_name).result()
+            except Exception as e:
+                print('refresh node %s failed, serving its last data: %s' % (db_name, e))
+                logging.warning('refresh node %s failed: %s' % (db_name, e))
+                continue
+            node_rebuild, node_error = self.apply_node(db_name, result)
+            rebuild_error = rebuild_error or node_rebuild
+            new_error += node_error
+            timings[db_name] = result['time']
+        # 删除已不存在的节点
+        for key in list(self.sources):
+            if key[0] not in db_names:
+                del self.sources[key]
+                self.layouts.pop(key, None)
+                self.reloading.discard(key)
+                self.replays.pop(key, None)
+                rebuild_error = True
+        for db_name in list(self.db_content):
+            if db_name not in db_names:
+                del self.db_content[db_name]
+                self.node_marks.pop(db_name, None)
+                self.reloading_nodes.discard(db_name)
+        self.publish(rebuild_error, new_error)
+        # 各节点的查询耗时
+        for db_name in timings:
+            logging.debug('node %s refreshed in %.3f sec' % (db_name, timings[db_name]))
+        if timings:
+            slowest = max(timings, key=timings.get)
+            print('%s   |   %s nodes refreshed, slowest %s (%.3f sec)' %
+                  (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), len(timings), slowest, timings[slowest]))
+
+    # 接收推送的新日志，直到deadline或推送中断（中断时返回，由轮询补上中断期间的日志）
+    # 两次发布至少间隔publish_interval，期间到达的新日志合并后一起发布
+    def wait_events(self, deadline):
+        changes = None  # 尚未发布的变动：[故障日志是否需要整体重建, 新增的故障日志, 有变动的表]
+        while 1:
+            now = time.time()
+            if changes is not None and now >= self.last_publish + self.publish_interval:
+                self.publish(*changes)
+                changes = None
+            if now >= deadline:
+                break
+            timeout = deadline - now
+            if changes is not None:
+                timeout = min(timeout, self.last_publish + self.publish_interval - now)
+            try:
+                event = self.events.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            # 汇总短时间内到达的所有新日志，按表分组
+            new_dict = {}
+            while event is not None:
+                db_name, col_name, data = event
+                # 合并表中的日志按来源区分
+                if col_name == db_connect.CONSOLIDATED_COLLECTION:
+                    col_name = data.pop('source')
+                    self.layouts[(db_name, col_name)] = 1
+                new_dict.setdefault((db_name, col_name), []).append(data)
+                try:
+                    event = self.events.get_nowait()
+                except queue.Empty:
+                    break
+            if changes is None:
+                changes = [False, [], set()]
+            for key in new_dict:
+                if not self.is_log_col(key[1]):
+                    continue
+                if key in self.sources:
+                    changes[1] += self.merge_new(key, new_dict[key])
+                else:
+                    self.sources[key] = self.load_source(key[0], key[1])
+                    changes[0] = True
+                changes[2].add(key)
+            if event is None:
+                break
+        if changes is not None:
+            self.publish(*changes)
+
+    # 汇总所有表的数据，保存在全局变量中，方便api类调用
+    # 同时建立按(节点名, 日志来源)的索引，并为不带参数的查询接口预先生成响应，每轮只序列化一次
+    # changed为有变动的表（为None时全部有变动），只重新生成这些表的统计列表和分页索引，其余沿用上次的结果
+    def publish(self, rebuild_error, new_error, changed=None):
+        global DETAIL, DETAIL_ERROR, SOURCE_STATUS, STATISTICS_ERROR, STATISTICS_WARN, STATISTICS_NORMAL, RESPONSES, \
+            DETAIL_BY_SOURCE, STATISTICS_BY_SOURCE, DETAIL_PAGES, STATISTICS_PAGES
+        self.last_publish = time.time()
+        if changed is None:
+            self.views = {}
+        for key in list(self.views):
+            if key not in self.sources or key in changed:
+                del self.views[key]
+        temp_detail = []
+        temp_source_status = []
+        temp_statistics_error = []
+        temp_statistics_warn = []
+        temp_statistics_normal = []
+        temp_detail_by_source = {}
+        temp_statistics_by_source = {}
+        for key in self.sources:
+            source = self.sources[key]
+            if key not in self.views:
+                statistics = {'statistics error': self.statistics_list(key, source['statistics'][2]),
+                              'statistics warn': self.statistics_list(key, source['statistics'][1]),
+                              'statistics normal': self.statistics_list(key, source['statistics'][0])}
+                self.views[key] = {'statistics': statistics, 'pages': source_pages(source['detail'], statistics)}
+            statistics = self.views[key]['statistics']
+            temp_detail += source['detail']
+            if source['status']:
+                temp_source_status.append(source['status'])
+            temp_statistics_error += statistics['statistics error']
+            temp_statistics_warn += statistics['statistics warn']
+            temp_statistics_normal += statistics['statistics normal']
+            temp_detail_by_source[key] = source['detail']
+            temp_statistics_by_source[key] = statistics
+        temp_detail_pages, temp_statistics_pages = build_pages(
+            temp_detail_by_source, temp_statistics_by_source, {key: self.views[key]['pages'] for key in self.views})
+        # 异常日志整体重建时合并各表的按列数据，否则增量追加（ErrorBuffer自带锁）
+        if rebuild_error:
+            temp_detail_error = error_buffer.ErrorBuffer.merge([self.sources[key]['errors'] for key in self.sources],
+                                                               self.error_buffer_size)
+        self.threadLock.acquire()
+        DETAIL = temp_detail
+        if rebuild_error:
             DETAIL_ERROR = temp_detail_error
-            SOURCE_STATUS = temp_source_status
-            STATISTICS_ERROR = temp_statistics_error
-            STATISTICS_WARN = temp_statistics_warn
-            STATISTICS_NORMAL = temp_statistics_normal
-            self.threadLock.release()
-            while time.time() - start_time < 3:
-                time.sleep(1)
-
-    # 返回最新的表名和数据库名
-    def check_db_and_col_names(self):
+        else:
+            DETAIL_ERROR.extend(new_error)
+        SOURCE_STATUS = temp_source_status
+        STATISTICS_ERROR = temp_statistics_error
+        STATISTICS_WARN = temp_statistics_warn
+        STATISTICS_NORMAL = temp_statistics_normal
+        DETAIL_BY_SOURCE = temp_detail_by_source
+        STATISTICS_BY_SOURCE = temp_statistics_by_source
+        DETAIL_PAGES = temp_detail_pages
+        STATISTICS_PAGES = temp_statistics_pages
+        self.threadLock.release()
+        # 只有本线程修改DETAIL_ERROR，在锁外读取即可
+        payloads = {
+            'request_detail': {'msg': temp_detail},
+            'request_detail_error': {'msg': DETAIL_ERROR.latest(100, classes=(2, 1))},
+            'request_source_status': {'msg': temp_source_status},
+            'request_statistics': {'statistics error': temp_statistics_error,
+                                   'statistics warn': temp_statistics_warn,
+                                   'statistics normal': temp_statistics_normal},
+        }
+        responses = {}
+        for name in payloads:
+            responses[name] = build_response(name, payloads[name])
+        self.threadLock.acquire()
+        RESPONSES = responses
+        self.threadLock.release()
+        if self.publisher is not None:
+            self.publish_shared(rebuild_error, new_error, responses, temp_detail_by_source, temp_statistics_by_source)
+
+    # 多进程部署时，将接口用到的数据发布为快照，供各接口进程读取；数据没有变动时不重新发布
+    def publish_shared(self, rebuild_error, new_error, responses, detail_by_source, statistics_by_source):
+        etags = {name: responses[name]['etag'] for name in responses}
+        warmup_cutoffs = WARMUP_CUTOFFS
+        if not rebuild_error and not new_error and etags == self.published_etags and \
+                warmup_cutoffs is self.published_cutoffs:
+            return
+        arrays = {}
+        columns = DETAIL_ERROR.dump()
+        for field in columns:
+            arrays['errors/%s' % field] = columns[field]
+        # 编码表只增不减，在导出故障日志之后读取
+        meta = {'responses': responses,
+                'detail by source': [{'machine': key[0], 'source': key[1], 'detail': detail_by_source[key]}
+                                     for key in detail_by_source],
+                'statistics by source': [{'machine': key[0], 'source': key[1], 'statistics': statistics_by_source[key]}
+                                         for key in statistics_by_source],
+                'machines': list(error_buffer.MACHINES.values), 'source names': list(error_buffer.SOURCES.values),
+                'warmup cutoffs': warmup_cutoffs}
+        try:
+            self.publisher.save(meta, arrays)
+        except Exception as e:
+            print('publish shared state failed: %s' % e)
+            logging.warning('publish shared state failed: %s' % e)
+            return
+        self.published_etags = etags
+        self.published_cutoffs = warmup_cutoffs
+
+    # 更新各节点的预热截止时间，只在有collector重新标注初始化时间（最新一条记录的_id变化）时重新读取，
+    # 已注册过的节点重新注册时，该节点的所有表重新加载
+    def refresh_init_time(self):
+        global WARMUP_CUTOFFS
+        conn = db_connect.DataBase(None, self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'], check=1)
+        mark = conn.check_init_time_mark()
+        if mark == self.init_time_mark:
+            return
+        cutoffs = {}
+        init_time_dict = conn.check_init_time()
+        for machine in init_time_dict:
+            cutoffs[machine] = init_time_dict[machine] + datetime.timedelta(seconds=2)
+            # collector重新启动（如--fresh删除并重建了数据库，库名和表名不变）后，该节点的所有表重新加载
+            if machine in WARMUP_CUTOFFS and WARMUP_CUTOFFS[machine] != cutoffs[machine]:
+                print('node %s registered again, reloading' % machine)
+                self.reload_node(machine)
+        self.threadLock.acquire()
+        WARMUP_CUTOFFS = cutoffs
+        self.threadLock.release()
+        self.init_time_mark = mark
+
+    # 将内存数据和各表的高水位保存为快照，到达保存间隔时才保存
+    # 故障日志按列保存为数组，其余数据保存在元数据中
+    def save_snapshot(self):
+        if self.snapshot is None or not self.snapshot.due(time.time()):
+            return
+        start_time = time.time()
+        sources = []
+        arrays = {}
+        for seq, key in enumerate(self.sources):
+            source = self.sources[key]
+            sources.append({'machine': key[0], 'source': key[1], 'layout': self.layouts.get(key, 0),
+                            'mark': source['mark'], 'detail': source['detail'], 'status': source['status'],
+                            'statistics': {str(urgent_class): source['statistics'][urgent_class]
+                                           for urgent_class in source['statistics']},
+                            'bucket': source['bucket'], 'rollup start': source['rollup start']})
+            columns = source['errors'].dump()
+            for field in columns:
+                arrays['%s/%s' % (seq, field)] = columns[field]
+        # 编码表只增不减，在导出故障日志之后读取，包含故障日志中的所有编码
+        meta = {'sources': sources, 'node marks': self.node_marks, 'replay mark': self.replay_mark,
+                'replays': [{'machine': key[0], 'source': key[1], 'min id': self.replays[key]} for key in self.replays],
+                'machines': list(error_buffer.MACHINES.values), 'source names': list(error_buffer.SOURCES.values),
+                'analyse data': json.dumps(ANALYSE_DATA, cls=DateEncoder, ensure_ascii=False),
+                'warmup cutoffs': WARMUP_CUTOFFS}
+        self.snapshot.last_save = time.time()
+        try:
+            self.snapshot.save(meta, arrays)
+        except Exception as e:
+            print('save snapshot failed: %s' % e)
+            logging.warning('save snapshot failed: %s' % e)
+            return
+        print('%s   |   snapshot saved, %s sources, %.3f sec used' %
+              (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), len(sources), time.time() - start_time))
+
+    # 从快照恢复内存数据和各表的高水位，之后的轮询从快照中的高水位继续增量查询
+    def restore_snapshot(self):
+        global ANALYSE_DATA, WARMUP_CUTOFFS
+        loaded = self.snapshot.load()
+        if loaded is None:
+            return
+        meta, arrays = loaded
+        # 快照内容与当前版本不符（缺少数组、故障日志的字段有变动等）时放弃快照，所有表从头加载
+        try:
+            for seq in range(len(meta['sources'])):
+                data = meta['sources'][seq]
+                key = (data['machine'], data['source'])
+                columns = {field: arrays['%s/%s' % (seq, field)] for field in error_buffer.FIELDS}
+                self.sources[key] = {'mark': data['mark'], 'detail': data['detail'], 'status': data['status'],
+                                     'errors': error_buffer.ErrorBuffer.load(columns, meta['machines'],
+                                                                             meta['source names'],
+                                                                             self.error_buffer_size),
+                                     'statistics': {int(urgent_class): data['statistics'][urgent_class]
+                                                    for urgent_class in data['statistics']},
+                                     'bucket': data['bucket'], 'rollup start': data.get('rollup start')}
+                self.layouts[key] = data['layout']
+            self.node_marks = meta['node marks']
+            self.replay_mark = meta.get('replay mark', 0)
+            replays = {(data['machine'], data['source']): data['min id'] for data in meta.get('replays', [])}
+            analyse_data = json.loads(meta['analyse data'])
+            warmup_cutoffs = meta['warmup cutoffs']
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            print('snapshot incompatible, reloading all sources: %s' % e)
+            logging.warning('snapshot incompatible: %s' % e)
+            self.sources = {}
+            self.layouts = {}
+            self.node_marks = {}
+            self.replay_mark = 0
+            return
+        self.replays = replays
+        ANALYSE_DATA = analyse_data
+        WARMUP_CUTOFFS = warmup_cutoffs
+        self.snapshot.last_save = time.time()
+        print('snapshot loaded, %s sources' % len(self.sources))
+
+    # 有collector从本地缓存补传日志时，记录对应的表需要重新查询的最小_id
+    # 补传的日志时间较早，_id可能小于已读取的高水位而被增量查询跳过，所在的小时也可能早于增量读取的汇总表时间段
+    def refresh_replays(self):
+        conn = db_connect.DataBase(None, self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'], check=1)
+        # 首次读取时只记录起点，此时所有表都是新加载的
+        if self.replay_mark == 0:
+            self.replay_mark = conn.check_replay_mark()
+            return
+        for data in conn.check_replays(self.replay_mark):
+            self.replay_mark = data['_id']
+            for item in data['sources']:
+                key = (data['machine'], item['source'])
+                if key in self.sources:
+                    self.replays[key] = min(self.replays.get(key, item['min id']), item['min id'])
+                    print('logs of %s.%s replayed from spool, requerying' % key)
+
+    # 首次加载一张表：记录当前的高水位，查询高水位及之前的数据，consolidated为是否存储在合并表中（为None时从self.layouts读取）
+    def load_source(self, db_name, col_name, consolidated=None):
+        source = {'mark': None, 'detail': [], 'status': None,
+                  'errors': error_buffer.ErrorBuffer(self.error_buffer_size),
+                  'statistics': {0: {}, 1: {}, 2: {}},
+                  'bucket': None, 'rollup start': None}
+        conn = self.connect(db_name, col_name, consolidated)
+        source['rollup start'] = conn._request_rollup_start(col_name)
+        source['mark'] = conn._request_last_id(col_name)
+        if source['mark'] is None:
+            return source
+        source['detail'] = self.get_detail(db_name, col_name, max_id=source['mark'], consolidated=consolidated)
+        for data in self.get_detail(db_name, col_name, limit=1, max_id=source['mark'], consolidated=consolidated):
+            del data['log id']
+            source['status'] = data
+        source['errors'].extend(self.get_detail(db_name, col_name, urgent_class=2, limit=-1, max_id=source['mark'],
+                                                consolidated=consolidated))
+        source['statistics'] = self.get_statistics(db_name, col_name, max_id=source['mark'], consolidated=consolidated)
+        source['bucket'] = max([hour for counter in source['statistics'].values() for hour in counter], default=None)
+        return source
+
+    # 一个节点当前的查询起点（在本线程中读取，交给fetch_node），返回值为：
+    # {表名: 高水位}，合并表的高水位（0表示尚未记录），读取汇总表的起始小时（已读取过的最新小时的前一小时），
+    # {表名: 需要重新查询的最小_id}（有日志补传的表）
+    def node_state(self, db_name):
+        marks = {}
+        buckets = []
+        replays = {}
+        for key in self.sources:
+            if key[0] == db_name and key not in self.reloading:
+                marks[key[1]] = self.sources[key]['mark']
+                if self.sources[key]['bucket']:
+                    buckets.append(self.sources[key]['bucket'])
+                if key in self.replays:
+                    replays[key[1]] = self.replays[key]
+        since = None
+        if buckets:
+            since = (datetime.datetime.strptime(max(buckets), '%Y-%m-%d-%H') -
+                     datetime.timedelta(hours=1)).strftime('%Y-%m-%d-%H')
+        if db_name in self.reloading_nodes:
+            return marks, 0, since, replays
+        return marks, self.node_marks.get(db_name, 0), since, replays
+
+    # 标记一个节点的所有表重新加载，重新加载的结果合并前沿用原有数据（节点查询超时时接口仍返回原有数据）
+    def reload_node(self, db_name):
+        self.reloading.update(key for key in self.sources if key[0] == db_name)
+        self.reloading_nodes.add(db_name)
+
+    # 查询一个节点（在线程池中执行，只查询数据库，不修改内存数据），返回值为查询结果字典：
+    # 'col_names': {表名: 是否存储在合并表中}，'node_mark': 合并表的高水位（首次查询时），'node_new': 合并表中的新日志，
+    # 'new': {表名: 新日志}，'loaded': {表名: 首次加载的数据}，'rollup': 汇总表中的计数，'time': 查询耗时，
+    # 'replayed': {表名: {'min id': 重新查询的最小_id, 'rows': 重新查询的日志, 'statistics': 这些日志所在小时的聚合计数}}
+    # 每张表只查询高水位之后的新日志；合并表中所有来源的新日志只查询一次，汇总表整个节点只查询一次
+    # 有日志补传的表重新查询_id不小于补传日志最小_id的日志，并重新统计其所在的小时
+    def fetch_node(self, db_name, marks, node_mark, since, replays):
+        start_time = time.time()
+        result = {'col_names': self.check_col_names(db_name), 'node_mark': node_mark, 'node_new': None,
+                  'new': {}, 'loaded': {}, 'rollup': [], 'replayed': {}}
+        col_names = result['col_names']
+        if 1 in col_names.values():
+            conn = db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
+                                       self.params['db_ip'], consolidated=1)
+            # 首次查询时只记录高水位，各来源由load_source加载
+            if node_mark == 0:
+                result['node_mark'] = conn._request_last_id(None)
+            else:
+                result['node_new'] = conn._request_new(None, node_mark)
+        for col_name in col_names:
+            if col_name not in marks:
+                result['loaded'][col_name] = self.load_source(db_name, col_name, col_names[col_name])
+            elif not col_names[col_name]:
+                conn = self.connect(db_name, col_name, 0)
+                result['new'][col_name] = conn._request_new(col_name, marks[col_name])
+        for col_name in replays:
+            if col_name not in col_names or col_name not in marks:
+                continue
+            conn = self.connect(db_name, col_name, col_names[col_name])
+            rows = conn._request_new(col_name, replays[col_name], inclusive=True)
+            statistics = []
+            if rows:
+                first = min(data['time'] for data in rows).replace(minute=0, second=0, microsecond=0)
+                last = max(data['time'] for data in rows).replace(minute=0, second=0, microsecond=0)
+                statistics = conn._aggregate_statistics(col_name, max_id=rows[-1]['_id'], since=first,
+                                                        until=last + datetime.timedelta(hours=1))
+            result['replayed'][col_name] = {'min id': replays[col_name], 'rows': rows, 'statistics': statistics}
+        conn = db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'])
+        result['rollup'] = conn._request_rollup(None, 'hour', since=since)
+        result['time'] = time.time() - start_time
+        return result
+
+    # 将一个节点的查询结果合并到内存数据中，返回值为(故障日志是否需要整体重建, 新增的故障日志)
+    def apply_node(self, db_name, result):
+        rebuild_error = False
+        new_error = []
+        col_names = result['col_names']
+        self.db_content[db_name] = col_names
+        for col_name in col_names:
+            self.layouts[(db_name, col_name)] = col_names[col_name]
+        # 合并表中的新日志，按来源分别合并，尚未加载的来源跳过
+        if result['node_new'] is None:
+            self.reloading_nodes.discard(db_name)
+            if 1 in col_names.values():
+                self.node_marks[db_name] = result['node_mark']
+        elif result['node_new']:
+            self.node_marks[db_name] = result['node_new'][-1]['_id']
+            new_dict = {}
+            for data in result['node_new']:
+                new_dict.setdefault((db_name, data.pop('source')), []).append(data)
+            for key in new_dict:
+                if key in self.sources:
+                    new_error += self.merge_new(key, new_dict[key])
+        # 每张表的新日志
+        for col_name in result['new']:
+            if (db_name, col_name) in self.sources:
+                new_error += self.merge_new((db_name, col_name), result['new'][col_name])
+        # 有日志补传的表，重新查询的结果覆盖后才不再重新查询
+        for col_name in result['replayed']:
+            key = (db_name, col_name)
+            replayed = result['replayed'][col_name]
+            if key in self.sources and key not in self.reloading:
+                new_error += self.merge_replayed(key, replayed['rows'], replayed['statistics'])
+                if key in self.replays and self.replays[key] >= replayed['min id']:
+                    del self.replays[key]
+        # 首次加载（或因补传重新加载）的表
+        for col_name in result['loaded']:
+            key = (db_name, col_name)
+            if key not in self.sources or key in self.reloading:
+                self.sources[key] = result['loaded'][col_name]
+                self.reloading.discard(key)
+                rebuild_error = True
+        # 删除已不存在的表
+        for key in list(self.sources):
+            if key[0] == db_name and key[1] not in col_names:
+                del self.sources[key]
+                self.layouts.pop(key, None)
+                self.reloading.discard(key)
+                self.replays.pop(key, None)
+                rebuild_error = True
+        self.apply_statistics(db_name, result['rollup'])
+        return rebuild_error, new_error
+
+    # 用汇总表中的计数更新一个节点所有来源最近的统计，以汇总表中的计数为准
+    # 最早的汇总时间段（升级时所在的小时）汇总不完整，保留加载时聚合查询和增量合并的计数
+    def apply_statistics(self, db_name, rollup):
+        rollup = [data for data in rollup if (db_name, data['_id']['source']) in self.sources]
+        for data in rollup:
+            source = self.sources[(db_name, data['_id']['source'])]
+            if source['rollup start'] is None:
+                source['rollup start'] = min(item['_id']['date'] for item in rollup
+                                             if item['_id']['source'] == data['_id']['source'])
+        rollup = [data for data in rollup
+                  if data['_id']['date'] > self.sources[(db_name, data['_id']['source'])]['rollup start']]
+        # 先清零再累加（多个告警级别可能归为同一类）
+        for data in rollup:
+            source = self.sources[(db_name, data['_id']['source'])]
+            source['statistics'][self.statistics_class(data['_id']['urgent class'])][data['_id']['date']] = 0
+        for data in rollup:
+            source = self.sources[(db_name, data['_id']['source'])]
+            counter = source['statistics'][self.statistics_class(data['_id']['urgent class'])]
+            counter[data['_id']['date']] += data['count']
+            source['bucket'] = max(source['bucket'] or data['_id']['date'], data['_id']['date'])
+
+    # 将新日志（含_id，不含日志内容）合并到一张表的内存数据中，返回值为新增的故障日志
+    # 不大于高水位的日志已经读取过，直接跳过
+    def merge_new(self, key, new_list):
+        source = self.sources[key]
+        if source['mark'] is not None:
+            new_list = [data for data in new_list if data['_id'] > source['mark']]
+        if not new_list:
+            return []
+        source['mark'] = max(data['_id'] for data in new_list)
+        for data in new_list:
+            del data['_id']
+            data['machine'] = key[0]
+            data['source'] = key[1]
+            # 增量更新统计
+            hour = data['time'].strftime('%Y-%m-%d-%H')
+            counter = source['statistics'][self.statistics_class(data['urgent class'])]
+            counter[hour] = counter.get(hour, 0) + 1
+        # 合并最新的100条日志
+        source['detail'] = sorted(new_list + source['detail'], key=lambda i: i['time'], reverse=True)[:100]
+        status = dict(source['detail'][0])
+        del status['log id']
+        source['status'] = status
+        # 新增的故障日志
+        new_error = [data for data in new_list if data['urgent class'] == 2]
+        source['errors'].extend(new_error)
+        return new_error
+
+    # 将有日志补传的表重新查询的日志合并到内存数据中，返回值为新增的故障日志
+    # 重新查询的日志中有已读取过的，按日志id去重；所在小时的统计以聚合查询的计数替换，可重复合并
+    def merge_replayed(self, key, rows, statistics):
+        if not rows:
+            return []
+        source = self.sources[key]
+        max_id = rows[-1]['_id']
+        first = min(data['time'] for data in rows).strftime('%Y-%m-%d-%H')
+        last = max(data['time'] for data in rows).strftime('%Y-%m-%d-%H')
+        for data in rows:
+            del data['_id']
+            data['machine'] = key[0]
+            data['source'] = key[1]
+        # 合并最新的100条日志
+        known = set(data['log id'] for data in source['detail'])
+        source['detail'] = sorted([data for data in rows if data['log id'] not in known] + source['detail'],
+                                  key=lambda i: i['time'], reverse=True)[:100]
+        status = dict(source['detail'][0])
+        del status['log id']
+        source['status'] = status
+        # 替换这些小时的统计
+        for counter in source['statistics'].values():
+            for hour in [hour for hour in counter if first <= hour <= last]:
+                del counter[hour]
+        for data in statistics:
+            counter = source['statistics'][self.statistics_class(data['_id']['urgent class'])]
+            counter[data['_id']['date']] = counter.get(data['_id']['date'], 0) + data['count']
+        if source['mark'] is None or max_id > source['mark']:
+            source['mark'] = max_id
+        # 尚未读取过的故障日志
+        errors = [data for data in rows if data['urgent class'] == 2]
+        known = source['errors'].contains([data['log id'] for data in errors])
+        new_error = [errors[seq] for seq in range(len(errors)) if not known[seq]]
+        source['errors'].extend(new_error)
+        return new_error
+
+    # 统计时的告警级别分类：2为故障，1为警告，其余为正常
+    @staticmethod
+    def statistics_class(urgent_class):
+        if urgent_class == 2 or urgent_class == 1:
+            return urgent_class
+        return 0
+
+    # 将一张表的统计计数转为列表，按时间倒序排列
+    @staticmethod
+    def statistics_list(key, counter):
+        return_list = []
+        for hour in sorted(counter, reverse=True):
+            return_list.append({'time': hour, 'count': counter[hour], 'machine': key[0], 'source': key[1]})
+        return return_list
+
+    # 是否为日志表（排除备份表、汇总表和合并表）
+    @staticmethod
+    def is_log_col(col_name):
+        return col_name[:12] != '[log backup]' and col_name not in db_connect.ROLLUP_NAMES and \
+            col_name != db_connect.CONSOLIDATED_COLLECTION
+
+    # 连接日志表所在的数据库，存储在合并表中的日志来源使用合并表
+    # consolidated为None时从self.layouts读取，在线程池中执行时由调用方传入，不读取self.layouts
+    def connect(self, db_name, col_name, consolidated=None):
+        if consolidated is None:
+            consolidated = self.layouts.get((db_name, col_name), 0)
+        return db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'], consolidated=consolidated)
+
+    # 返回最新的数据库名（即节点名称）
+    def check_db_names(self):
         db_names = []
-        db_content = {}
-        # 获取数据库名和表名
         conn = db_connect.DataBase(None, self.params['db_user'], self.params['db_password'],
                                    self.params['db_ip'], check=1)
-        # 获取数据库名（即节点名称）
         for name in conn.get_db_names():
-            if name not in ['admin', 'config', 'local']:
+            if name not in ['admin', 'config', 'local', 'init_time']:
                 db_names.append(name)
-        # 获取每个数据库中的表名（即日志来源名称）
-        for db_name in db_names:
-            col_name_list = []
-            for name in conn.get_col_names(db_name):
-                if name[:12] != '[log backup]':
-                    col_name_list.append(name)
-            db_content[db_name] = col_name_list
-        return db_content
+        return db_names
+
+    # 返回一个数据库中的表名（即日志来源名称），返回值为{表名: 是否存储在合并表中}
+    # 合并表中的日志来源与同名的表同时存在时，以合并表为准
+    def check_col_names(self, db_name):
+        conn = db_connect.DataBase(None, self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'], check=1)
+        col_names = {}
+        consolidated = 0
+        for name in conn.get_col_names(db_name):
+            if self.is_log_col(name):
+                col_names[name] = 0
+            elif name == db_connect.CONSOLIDATED_COLLECTION:
+                consolidated = 1
+        if consolidated:
+            for name in conn.get_sources(db_name):
+                col_names[name] = 1
+        return col_names
 
     # 获取detail数据
-    def get_detail(self, db_name, col_name, urgent_class=-1, limit=100):
+    def get_detail(self, db_name, col_name, urgent_class=-1, limit=100, max_id=None, consolidated=None):
         return_list = []
-        conn = db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
-                                   self.params['db_ip'])
-        for data in conn._request_detail(col_name, urgent_class=urgent_class, limit=limit):
+        conn = self.connect(db_name, col_name, consolidated)
+        for data in conn._request_detail(col_name, urgent_class=urgent_class, limit=limit, max_id=max_id):
             data['machine'] = db_name
             data['source'] = col_name
             return_list.append(data)
         return return_list
 
-    # 日志统计
-    def get_statistics(self, db_name, col_name):
-        statistics_error = []
-        statistics_warn = []
-        statistics_normal = []
-        conn = db_connect.DataBase(db_name, self.params['db_user'], self.params['db_password'],
-                                   self.params['db_ip'])
-        for data in conn._request_statistics(col_name):
-            temp_dict = {}
-            temp_dict['time'] = data['_id']['date']
-            temp_dict['count'] = data['count']
-            temp_dict['machine'] = db_name
-            temp_dict['source'] = col_name
-            if data['_id']['urgent class'] == 2:
-                statistics_error.append(temp_dict)
-            elif data['_id']['urgent class'] == 1:
-                statistics_warn.append(temp_dict)
-            else:
-                statistics_normal.append(temp_dict)
-        return statistics_error, statistics_warn, statistics_normal
+    # 日志统计，返回值为{告警级别: {小时: 条数}}
+    def get_statistics(self, db_name, col_name, max_id=None, consolidated=None):
+        statistics = {0: {}, 1: {}, 2: {}}
+        conn = self.connect(db_name, col_name, consolidated)
+        for data in conn._request_statistics(col_name, max_id=max_id):
+            counter = statistics[self.statistics_class(data['_id']['urgent class'])]
+            counter[data['_id']['date']] = counter.get(data['_id']['date'], 0) + data['count']
+        return statistics
+
+
+# 通过change stream接收数据库推送的新日志（需要副本集部署），放入事件队列
+# 推送中断时放入None，通知GetStatisticsFromMongoDB立即轮询一次，补上中断期间的日志
+class WatchMongoDB(threading.Thread):
+    # 初始化参数：数据库ip，数据库用户，数据库密码，事件队列，中断后的重试间隔（秒）
+    def __init__(self, db_ip, db_user, db_password, events, retry_interval=5):
+        threading.Thread.__init__(self, daemon=True)
+        self.params = {}
+        # 数据库连接参数
+        self.params['db_ip'] = db_ip
+        self.params['db_user'] = db_user
+        self.params['db_password'] = db_password
+        self.events = events
+        self.retry_interval = retry_interval
+        self.dropped = 0  # 队列已满时丢弃的事件数
+
+    # 放入事件队列，不阻塞接收推送
+    # 队列已满（刷新线程处理不及）时丢弃事件，之后先放入一次轮询请求，丢弃的日志由轮询补上
+    # 之后一直没有新事件时，由下一次定时轮询补上
+    def push(self, event):
+        try:
+            if self.dropped:
+                self.events.put_nowait(None)
+                print('event queue recovered, %s events dropped, polling' % self.dropped)
+                self.dropped = 0
+            self.events.put_nowait(event)
+        except queue.Full:
+            if not self.dropped:
+                logging.warning('event queue full, dropping events until it drains')
+            self.dropped += 1
+
+    def run(self):
+        resume_token = None
+        while 1:
+            try:
+                conn = db_connect.DataBase(None, self.params['db_user'], self.params['db_password'],
+                                           self.params['db_ip'], check=1)
+                with conn._watch_inserts(resume_token) as stream:
+                    # 推送已建立（或已恢复），轮询一次补上建立之前的日志
+                    self.push(None)
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self.push((change['ns']['db'], change['ns']['coll'], change['fullDocument']))
+            except Exception as e:
+                print('change stream interrupted, retry in %s sec: %s' % (self.retry_interval, e))
+                logging.warning('change stream interrupted: %s' % e)
+                # 无法从中断处恢复时，从当前时刻重新开始，中断期间的日志由轮询补上
+                if isinstance(e, db_connect.OperationFailure):
+                    resume_token = None
+                time.sleep(self.retry_interval)
 
 
 # ----------------------------------------flask api类----------------------------------------
 # *******************************************************************************************
 
+# 多进程部署时接口进程使用的数据：刷新进程发布的快照和各接口进程共用的分析数据，文件变动时更新到全局变量
+class SharedState:
+    # 输入参数为：刷新进程发布数据的快照文件地址，分析数据文件地址
+    def __init__(self, state_path, analyse_path):
+        self.state = state_snapshot.SnapshotReader(state_path)
+        self.analyse = state_snapshot.SnapshotReader(analyse_path)
+
+    # 发布的数据或分析数据有变动时更新全局变量
+    def reload(self):
+        global RESPONSES, DETAIL_BY_SOURCE, STATISTICS_BY_SOURCE, DETAIL_ERROR, WARMUP_CUTOFFS, ANALYSE_DATA, \
+            DETAIL_PAGES, STATISTICS_PAGES
+        loaded = self.state.reload()
+        if loaded is not None:
+            meta, arrays = loaded
+            columns = {field: arrays['errors/%s' % field] for field in error_buffer.FIELDS}
+            DETAIL_ERROR = error_buffer.ErrorBuffer.load(columns, meta['machines'], meta['source names'])
+            DETAIL_BY_SOURCE = {(data['machine'], data['source']): data['detail'] for data in meta['detail by source']}
+            STATISTICS_BY_SOURCE = {(data['machine'], data['source']): data['statistics']
+                                    for data in meta['statistics by source']}
+            DETAIL_PAGES, STATISTICS_PAGES = build_pages(DETAIL_BY_SOURCE, STATISTICS_BY_SOURCE)
+            WARMUP_CUTOFFS = meta['warmup cutoffs']
+            RESPONSES = meta['responses']
+        loaded = self.analyse.reload()
+        if loaded is not None:
+            ANALYSE_DATA = json.loads(loaded[0]['analyse data'])
+
+    # 保存分析数据，各接口进程在下一个请求前读取
+    def save_analyse_data(self, analyse_data):
+        self.analyse.snapshot.save({'analyse data': json.dumps(analyse_data, cls=DateEncoder, ensure_ascii=False)},
+                                   {})
+
+
+# 生成flask应用
+# shared为多进程部署时读取刷新进程发布数据的SharedState，每个请求前更新全局变量；为None时直接使用本进程的全局变量
+def create_app(GetData, shared=None):
+    app = Flask(__name__)
+    MY_URL = '/cleaner/'
+
+    if shared is not None:
+        @app.before_request
+        def reload_shared_state():
+            shared.reload()
+
+    # 请求详细数据（每个日志来源100条日志）
+    # (可选)输入： {"source":<source>, "machine":<machine>}（两者需同时提供，也可作为URL查询参数）
+    # (可选)分页参数（请求体或URL查询参数）：since，until，limit，cursor，返回按时间倒序的一页数据和下一页的"next cursor"
+    @app.route(MY_URL + 'request_detail', endpoint='request_detail', methods=['GET'])
+    def request_detail():
+        logging.debug('request_detail received')
+        return_dict = {}
+        request_data = request.get_data()
+        print(request_data)
+        # 若无参数，则返回所有日志来源的全部数据
+        if request_data == b'' and not request.args:
+            return cached_response('request_detail')
+        # 获取传入参数
+        params = request_params(request_data)
+        try:
+            page = page_params(params)
+            key = source_key(params)
+        except ValueError as e:
+            return param_error(e)
+        # 只有无关参数时同样返回所有日志来源的全部数据
+        if page is None and key is None:
+            return cached_response('request_detail')
+        # 若包含分页参数，则返回指定日志来源（未指定时为所有日志来源）的一页数据
+        if page is not None:
+            pages, next_key = page_lists([DETAIL_PAGES.get(key, ([], []))], page['since'], page['until'],
+                                         page['cursor'], page['limit'])
+            return_dict['msg'] = pages[0]
+            return_dict['next cursor'] = encode_cursor(next_key)
+        # 若包含参数，则返回指定日志来源的数据
+        else:
+            return_dict['msg'] = DETAIL_BY_SOURCE.get(key, [])
+        return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
+
+    # 请求详细数据——分析模块专用
+    # 去除了collector程序启动后两秒之前的所有日志信息，以避免统计出错
+    # 只提取了告警日志
+    @app.route(MY_URL + 'request_detail_for_analyse', endpoint='request_detail_for_analyse', methods=['GET'])
+    def request_detail_for_analyse():
+        logging.debug('request_detail_for_analyse received')
+        return_dict = {}
+
+        # 按节点的预热截止时间向量化筛选出collector程序运行两秒后生成的最高告警级别日志，结果已按时间排序
+        # （初始化时间由GetStatisticsFromMongoDB在有collector重新启动时更新）
+        return_dict['msg'] = DETAIL_ERROR.since_each(WARMUP_CUTOFFS, classes=(2,))
+        return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
+
+    # 获取最近100条异常数据
+    # (可选)分页参数（请求体或URL查询参数）：since，until，limit，cursor，返回按时间倒序的一页数据和下一页的"next cursor"
+    @app.route(MY_URL + 'request_detail_error', endpoint='request_detail_error', methods=['GET'])
+    def request_detail_error():
+        logging.debug('request_detail_error received')
+        request_data = request.get_data()
+        if request_data == b'' and not request.args:
+            return cached_response('request_detail_error')
+        try:
+            page = page_params(request_params(request_data))
+        except ValueError as e:
+            return param_error(e)
+        if page is None:
+            return cached_response('request_detail_error')
+        return_dict = {}
+        return_dict['msg'], next_key = DETAIL_ERROR.page(page['since'], page['until'], page['cursor'], page['limit'],
+                                                         classes=(2, 1))
+        return_dict['next cursor'] = encode_cursor(next_key)
+        return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
+
+    # 获取日志来源的状态
+    @app.route(MY_URL + 'request_source_status', endpoint='request_source_status', methods=['GET'])
+    def request_source_status():
+        logging.debug('request_detail received')
+        return cached_response('request_source_status')
+
+    # 请求统计数据
+    # (可选)输入： {"source":<source>, "machine":<machine>}（两者需同时提供，也可作为URL查询参数）
+    # (可选)分页参数（请求体或URL查询参数）：since，until，limit，cursor，按小时筛选与[since, until)有重叠的统计，
+    # 三类统计以同一个边界分页，每类按时间倒序最多limit条，并返回下一页的"next cursor"
+    # (可选)统计粒度参数granularity：hour（默认）或minute，minute时从分钟汇总表读取指定日志来源的统计（须提供machine和source），
+    # 只包含汇总表建立之后写入的日志，支持since，until，limit，不支持cursor
+    @app.route(MY_URL + 'request_statistics', endpoint='request_statistics', methods=['GET'])
+    def request_detail():
+        logging.debug('request_statistics received')
+        return_dict = {}
+        request_data = request.get_data()
+        # 若无参数，则返回所有日志来源的全部数据
+        if request_data == b'' and not request.args:
+            return cached_response('request_statistics')
+        # 获取传入参数
+        params = request_params(request_data)
+        try:
+            page = page_params(params, time_key=False)
+            key = source_key(params)
+            granularity = params.get('granularity', 'hour')
+            if granularity not in db_connect.ROLLUP_COLLECTIONS:
+                raise ValueError('granularity should be one of %s' % ', '.join(db_connect.ROLLUP_COLLECTIONS))
+            if granularity != 'hour' and (key is None or page is not None and page['cursor'] is not None):
+                raise ValueError('granularity %s needs machine and source, and does not support cursor' % granularity)
+        except ValueError as e:
+            return param_error(e)
+        # 按分钟等其他粒度的统计从汇总表查询
+        if granularity != 'hour':
+            page = page or {'since': None, 'until': None, 'limit': None}
+            return json.dumps(GetData.get_rollup_statistics(key, granularity, page['since'], page['until'],
+                                                            page['limit']), ensure_ascii=False)
+        # 只有无关参数时同样返回所有日志来源的全部数据
+        if page is None and key is None:
+            return cached_response('request_statistics')
+        # 若包含分页参数，则返回指定日志来源（未指定时为所有日志来源）的一页数据
+        if page is not None:
+            statistics = STATISTICS_PAGES.get(key, {})
+            since = None
+            if page['since'] is not None:
+                since = page['since'].strftime(HOUR_FORMAT)
+            # until所在的小时与[since, until)有重叠时包含该小时
+            until = None
+            if page['until'] is not None:
+                last = page['until'] - datetime.timedelta(microseconds=1)
+                until = (last.replace(minute=0, second=0, microsecond=0) +
+                         datetime.timedelta(hours=1)).strftime(HOUR_FORMAT)
+            pages, next_key = page_lists([statistics.get(name, ([], [])) for name in STATISTICS_NAMES], since, until,
+                                         page['cursor'], page['limit'])
+            for name, data_list in zip(STATISTICS_NAMES, pages):
+                return_dict[name] = data_list
+            return_dict['next cursor'] = encode_cursor(next_key)
+        # 若包含参数，则返回指定日志来源的数据
+        else:
+            statistics = STATISTICS_BY_SOURCE.get(key, {})
+            return_dict['statistics error'] = statistics.get('statistics error', [])
+            return_dict['statistics warn'] = statistics.get('statistics warn', [])
+            return_dict['statistics normal'] = statistics.get('statistics normal', [])
+        return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
+
+    # 请求日志条目
+    @app.route(MY_URL + 'request_data', endpoint='request_data', methods=['GET'])
+    def request_detail():
+        # 请求：{"machine": {"source":[id1, id2]}}
+        # 返回值：{"machine": {"source":{"id": "data"}}}
+        logging.debug('request_data received')
+        return_dict = {}
+        # 判断参数是否为空
+        if request.args is None:
+            return_dict['msg'] = '请求参数为空'
+            return json.dumps(return_dict, ensure_ascii=False)
+        # 获取传入参数，查询结果逐个节点流式返回
+        get_data_input = demjson.decode(request.get_data())
+        return Response(GetData.stream_data(get_data_input), mimetype='application/json')
+
+    # 请求分析数据
+    @app.route(MY_URL + 'request_analyse_data', endpoint='request_analyse_data', methods=['GET'])
+    def request_detail():
+        logging.debug('request_analyse_data request received')
+        return_dict = {}
+        return_dict = ANALYSE_DATA
+        return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
+
+    # 存入分析数据
+    @app.route(MY_URL + 'save_analyse_data', endpoint='save_analyse_data', methods=['POST'])
+    def request_detail():
+        global ANALYSE_DATA
+        logging.debug('save_analyse_data received')
+        return_dict = {}
+        # 判断参数是否为空
+        if request.args is None:
+            return_dict['success'] = 0
+            return_dict['msg'] = '请求参数为空'
+            return json.dumps(return_dict, ensure_ascii=False)
+        # 获取传入参数
+        ANALYSE_DATA = ast.literal_eval(demjson.decode(request.get_data()))
+        # 多进程部署时写入各接口进程共用的分析数据文件
+        if shared is not None:
+            shared.save_analyse_data(ANALYSE_DATA)
+        return_dict['success'] = 1
+        return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
+
+    return app
+
+
 class LocalAPI(threading.Thread):
     def __init__(self, GetData, threadLock):
         threading.Thread.__init__(self)
@@ -230,162 +1309,33 @@ class LocalAPI(threading.Thread):
         print('LocalAPI init')
 
     def run(self):
-        app = Flask(__name__)
-        MY_URL = '/cleaner/'
+        app = create_app(self.GetData)
         print('start service')
-
-        # 请求详细数据（每个日志来源100条日志）
-        # (可选)输入： {"source":<source>, "machine":<machine>}
-        @app.route(MY_URL + 'request_detail', endpoint='request_detail', methods=['GET'])
-        def request_detail():
-            logging.debug('request_detail received')
-            return_dict = {}
-            request_data = request.get_data()
-            print(request_data)
-            # 若无参数，则返回所有日志来源的全部数据
-            if request_data == b'':
-                return_dict['msg'] = DETAIL
-                return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-            # 若包含参数，则返回指定日志来源的数据
-            else:
-                # 获取传入参数
-                request_data = demjson.decode(request_data)
-                return_dict['msg'] = [n for n in DETAIL if
-                                      n['source'] == request_data['source']
-                                      and n['machine'] == request_data['machine']]
-                return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
-        # 请求详细数据——分析模块专用
-        # 去除了collector程序启动后两秒之前的所有日志信息，以避免统计出错
-        # 只提取了告警日志
-        @app.route(MY_URL + 'request_detail_for_analyse', endpoint='request_detail_for_analyse', methods=['GET'])
-        def request_detail_for_analyse():
-            logging.debug('request_detail_for_analyse received')
-            return_dict = {}
-
-            # 第一步，筛选出最高告警级别的日志
-            detail_1 = [x for x in DETAIL_ERROR if x['urgent class'] == 2]
-
-            # 第二步。筛选出collector程序运行两秒后生成的日志
-            init_time_dict = self.GetData.get_db_init_time()
-            detail_2 = [x for x in detail_1 if init_time_dict[x['machine']] +
-                        datetime.timedelta(seconds=2) < x['time']]
-
-            # 第三步，按照时间排序
-            detail_3 = sorted(detail_2, key=lambda i: i['time'])
-
-            return_dict['msg'] = detail_3
-            return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
-        # 获取最近100条异常数据
-        @app.route(MY_URL + 'request_detail_error', endpoint='request_detail_error', methods=['GET'])
-        def request_detail_error():
-            logging.debug('request_detail_error received')
-            return_dict = {}
-            # 第一步，筛选出最高告警级别的日志
-            detail_1 = [x for x in DETAIL_ERROR if x['urgent class'] == 2 or x['urgent class'] == 1]
-            # 第三步，按照时间排序
-            detail_2 = sorted(detail_1, key=lambda i: i['time'])
-            # 第三步，选取最新的最多100条日志
-            detail_3 = detail_2[len(detail_2) - 100:]
-            return_dict['msg'] = detail_3
-            return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
-        # 获取日志来源的状态
-        @app.route(MY_URL + 'request_source_status', endpoint='request_source_status', methods=['GET'])
-        def request_source_status():
-            logging.debug('request_detail received')
-            return_dict = {}
-            return_dict['msg'] = SOURCE_STATUS
-            return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
-        # 请求统计数据
-        # (可选)输入： {"source":<source>, "machine":<machine>}
-        @app.route(MY_URL + 'request_statistics', endpoint='request_statistics', methods=['GET'])
-        def request_detail():
-            logging.debug('request_statistics received')
-            return_dict = {}
-            request_data = request.get_data()
-            # 若无参数，则返回所有日志来源的全部数据
-            if request_data == b'':
-                return_dict['statistics error'] = STATISTICS_ERROR
-                return_dict['statistics warn'] = STATISTICS_WARN
-                return_dict['statistics normal'] = STATISTICS_NORMAL
-                return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-            # 若包含参数，则返回指定日志来源的数据
-            else:
-                # 获取传入参数
-                request_data = demjson.decode(request_data)
-                return_dict['statistics error'] = [n for n in STATISTICS_ERROR if
-                                                   n['source'] == request_data['source']
-                                                   and n['machine'] == request_data['machine']]
-                return_dict['statistics warn'] = [n for n in STATISTICS_ERROR if
-                                                  n['source'] == request_data['source']
-                                                  and n['machine'] == request_data['machine']]
-                return_dict['statistics normal'] = [n for n in STATISTICS_ERROR if
-                                                    n['source'] == request_data['source']
-                                                    and n['machine'] == request_data['machine']]
-                return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
-        # 请求日志条目
-        @app.route(MY_URL + 'request_data', endpoint='request_data', methods=['GET'])
-        def request_detail():
-            # 请求：{"machine": {"source":[id1, id2]}}
-            # 返回值：{"machine": {"source":{"id": "data"}}}
-            logging.debug('request_data received')
-            return_dict = {}
-            # 判断参数是否为空
-            if request.args is None:
-                return_dict['msg'] = '请求参数为空'
-                return json.dumps(return_dict, ensure_ascii=False)
-            # 获取传入参数
-            return_dict = self.GetData.get_data(demjson.decode(request.get_data()))
-            # GET_DATA_INPUT = demjson.decode(request.get_data())
-            return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
-        # 请求分析数据
-        @app.route(MY_URL + 'request_analyse_data', endpoint='request_analyse_data', methods=['GET'])
-        def request_detail():
-            logging.debug('request_analyse_data request received')
-            return_dict = {}
-            return_dict = ANALYSE_DATA
-            return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
-        # 存入分析数据
-        @app.route(MY_URL + 'save_analyse_data', endpoint='save_analyse_data', methods=['POST'])
-        def request_detail():
-            global ANALYSE_DATA
-            logging.debug('save_analyse_data received')
-            return_dict = {}
-            # 判断参数是否为空
-            if request.args is None:
-                return_dict['success'] = 0
-                return_dict['msg'] = '请求参数为空'
-                return json.dumps(return_dict, ensure_ascii=False)
-            # 获取传入参数
-            ANALYSE_DATA = ast.literal_eval(demjson.decode(request.get_data()))
-            return_dict['success'] = 1
-            return json.dumps(return_dict, cls=DateEncoder, ensure_ascii=False)
-
         app.run(threaded=True, processes=True, host='0.0.0.0', port=5000, debug=False, use_reloader=False)
 
 
-def main(argv):
-    ################# 自定义参数 #################
+# 解析命令行参数，返回值为(数据库ip, 数据库用户, 数据库密码, 是否使用推送模式, 是否只刷新数据不提供接口)
+# 多进程部署时，uWSGI接口进程（见cleaner_wsgi.py）以相同的参数解析数据库连接参数
+def parse_args(argv):
     # 数据库的地址及端口
     db_ip = ''
     db_user = ''
     db_password = ''
+    # 是否使用推送模式
+    change_stream = 0
+    # 是否只刷新数据并发布给uWSGI接口进程，不在本进程提供接口
+    refresh_only = 0
     try:
-        opts, args = getopt.getopt(argv, "hi:o:", ["help", "db_ip=", 'db_user=', 'db_password='])
+        opts, args = getopt.getopt(argv, "hi:o:", ["help", "db_ip=", 'db_user=', 'db_password=', 'change_stream',
+                                                   'refresh_only'])
     except getopt.GetoptError:
         print('usage:')
-        print('cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password>')
+        print('cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--change_stream] [--refresh_only]')
         sys.exit(2)
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             print('usage:')
-            print('cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password>')
+            print('cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--change_stream] [--refresh_only]')
             sys.exit()
         elif opt == "--db_ip":
             db_ip = str(arg)
@@ -393,23 +1343,65 @@ def main(argv):
             db_user = str(arg)
         elif opt == "--db_password":
             db_password = str(arg)
+        elif opt == "--change_stream":
+            change_stream = 1
+        elif opt == "--refresh_only":
+            refresh_only = 1
     # 检查参数完整性
     if db_ip == '' or db_user == '' or db_password == '':
         print('invaild input')
         print('usage:')
-        print('cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password>')
+        print('cleaner.py --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--change_stream] [--refresh_only]')
         sys.exit()
+    return db_ip, db_user, db_password, change_stream, refresh_only
+
+
+def main(argv):
+    ################# 自定义参数 #################
+    # 数据库的地址及端口，是否使用推送模式，是否只刷新数据（多进程部署）
+    db_ip, db_user, db_password, change_stream, refresh_only = parse_args(argv)
+
+    # 数据库连接池的最大连接数
+    db_pool_size = 50
+    db_connect.configure_pool(maxPoolSize=db_pool_size)
+    # 在内存中按时间排序保存的异常日志条数上限
+    error_buffer_size = 100000
+    # 并行查询节点的线程数（不超过数据库连接池的最大连接数），每轮等待节点查询完成的最长时间（秒）
+    refresh_workers = 16
+    node_timeout = 5
+    # 推送模式下事件队列的长度上限，队列已满时丢弃新事件，改为轮询补上
+    event_queue_size = 100000
+    # 内存状态快照的文件地址（为空时不使用快照，每次启动都从头查询数据库），保存间隔（秒）
+    snapshot_path = r'/var/lib/cleaner/snapshot.bin'
+    snapshot_interval = 60
+    snapshot = None
+    if snapshot_path:
+        snapshot = state_snapshot.StateSnapshot(snapshot_path, snapshot_interval)
+    # 多进程部署时，将接口数据发布到SHARED_STATE_PATH，由uWSGI接口进程提供接口
+    publisher = None
+    if refresh_only:
+        publisher = state_snapshot.StateSnapshot(SHARED_STATE_PATH)
 
     GetData = GetDataFromMongoDB(db_ip, db_user, db_password)
 
     # 多线程上锁
     threadLock = threading.Lock()
 
-    thread_GetStatisticsFromMongoDB = GetStatisticsFromMongoDB(db_ip, db_user, db_password, threadLock)
-    thread_LocalAPI = LocalAPI(GetData, threadLock)
+    # 推送模式下，change stream接收的新日志经事件队列交给GetStatisticsFromMongoDB
+    events = None
+    if change_stream:
+        events = queue.Queue(maxsize=event_queue_size)
+        thread_WatchMongoDB = WatchMongoDB(db_ip, db_user, db_password, events)
+        thread_WatchMongoDB.start()
 
+    thread_GetStatisticsFromMongoDB = GetStatisticsFromMongoDB(db_ip, db_user, db_password, threadLock,
+                                                               events=events, error_buffer_size=error_buffer_size,
+                                                               refresh_workers=refresh_workers, node_timeout=node_timeout,
+                                                               snapshot=snapshot, publisher=publisher)
     thread_GetStatisticsFromMongoDB.start()
-    thread_LocalAPI.start()
+    if not refresh_only:
+        thread_LocalAPI = LocalAPI(GetData, threadLock)
+        thread_LocalAPI.start()
 
 
 if __name__ == '__main__':
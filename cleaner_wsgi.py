@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# coding:utf-8
+
+'''
+日志处理程序的多进程接口入口（uWSGI）
+
+功能：
+日志处理程序以--refresh_only运行时只刷新数据，将接口数据发布到本地快照文件；
+本模块由uWSGI的多个工作进程加载，各进程从快照文件只读地提供与cleaner.py相同的接口，快照文件变动时重新映射
+
+部署：
+与日志处理程序部署在同一台机器上（共用快照文件），先启动日志处理程序，再启动uWSGI
+
+命令格式：   uwsgi --http 0.0.0.0:5000 --module cleaner_wsgi:application --processes <N> --threads <M> --lazy-apps
+             --pyargv "--db_ip <db_ip> --db_user <db_user> --db_password <db_password>"
+示例命令：   nohup python3 cleaner.py --db_ip xxx.xxx.xxx.xxx --db_user admin --db_password xxxxxxxx --refresh_only &
+             nohup uwsgi --http 0.0.0.0:5000 --module cleaner_wsgi:application --processes 8 --threads 4 --lazy-apps
+             --pyargv "--db_ip xxx.xxx.xxx.xxx --db_user admin --db_password xxxxxxxx" &
+
+数据库连接参数只用于request_data接口查询具体日志条目
+'''
+
+import sys
+
+import cleaner
+# 数据库连接类
+from connect_class import db_connect
+
+# 解析uWSGI --pyargv传入的参数
+db_ip, db_user, db_password, change_stream, refresh_only = cleaner.parse_args(sys.argv[1:])
+
+# 每个工作进程的数据库连接池的最大连接数
+db_pool_size = 10
+db_connect.configure_pool(maxPoolSize=db_pool_size)
+
+application = cleaner.create_app(cleaner.GetDataFromMongoDB(db_ip, db_user, db_password),
+                                 cleaner.SharedState(cleaner.SHARED_STATE_PATH, cleaner.ANALYSE_DATA_PATH))
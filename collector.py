@@ -13,17 +13,34 @@
 每个工作节点部署一个
 必须与数据库，日志提取程序，日志分析程序部署在同一网络下
 
-命令格式：   collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password>
+命令格式：   collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--fresh]
 示例命令：   nohup python3 collector.py --local_name m1 --db_ip aaa.bbb.ccc.ddd --db_user admin --db_password xxxxxx &
 
+默认从检查点继续收集日志；加上--fresh时清空本节点的数据库，从头收集所有日志
+
 '''
 
 import getopt
 import os, sys, json, time
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 # 数据库连接类
 from connect_class import db_connect
+# 日志文件追踪类
+from connect_class import log_tail
+# 日志变动监听类
+from connect_class import log_watch
+# 日志告警判断类
+from connect_class import log_judge
+# 日志上传类
+from connect_class import log_upload
+# 日志本地缓存类
+from connect_class import log_spool
+# 日志检查点类
+from connect_class import log_checkpoint
 
 # 设置日志格式，等级等
 LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s %(pathname)s %(message)s "  # 配置输出日志格式
@@ -37,8 +54,15 @@ logging.basicConfig(level=logging.DEBUG,
 
 # 收集日志
 class GetLog:
-    # 初始化参数： 本机名，数据库ip，数据库用户，数据库密码，自定义日志位置， 告警判断选项，告警规则
-    def __init__(self, local_name, db_ip, db_user, db_password, log_directory, judge, judge_rule):
+    # 初始化参数： 本机名，数据库ip，数据库用户，数据库密码，自定义日志位置， 告警判断选项，告警规则，告警规则是否忽略大小写，
+    # 上传队列长度，单批上传条数，上传时间间隔（秒），本地缓存目录（为空时不使用本地缓存），本地缓存大小上限（字节），
+    # 是否清空数据库从头收集，检查点文件地址（为空时不使用检查点），检查点保存间隔（秒），
+    # 单次读取的字节数上限，每个文件每轮最多读取的次数，并行读取日志的线程数，
+    # 是否将所有日志来源写入同一张合并表（=0时每个日志文件一张表）
+    def __init__(self, local_name, db_ip, db_user, db_password, log_directory, judge, judge_rule, judge_ignore_case=1,
+                 upload_queue_size=200, upload_batch_size=5000, upload_flush_interval=0.5, spool_directory='',
+                 spool_max_size=1024 * 1024 * 1024, fresh=0, checkpoint_path='', checkpoint_interval=5,
+                 chunk_size=512 * 1024, chunk_count=8, read_workers=4, consolidated=0):
         self.params = {}
         # 数据库参数(仅用于传参）
         self.params['local_name'] = local_name
@@ -48,22 +72,56 @@ class GetLog:
 
         self.judge = judge  # 告警判断选项，0为不判断1为判断
         self.judge_rule = judge_rule  # 告警规则
+        self.judger = log_judge.LogJudge(judge_rule, judge_ignore_case)  # 预编译的告警规则
+        self.id_counter = itertools.count()  # 日志id序号，多个读取线程共用（itertools.count在CPython中是线程安全的）
 
         self.log_directory = log_directory  # 自定义日志地址
-        self.log_len = {}  # 日志长度
+        self.chunk_size = chunk_size  # 单次读取的字节数上限
+        self.chunk_count = chunk_count  # 每个文件每轮最多读取的次数，读不完的下一轮继续，避免单个大文件阻塞其他文件
+        # 并行读取日志的线程池，线程数即同时读取的文件数上限，为1时顺序读取
+        self.pool = ThreadPoolExecutor(max_workers=read_workers) if read_workers > 1 else None
+        self.registry = log_tail.FileRegistry()  # 日志文件登记表，记录每个文件的读取状态（字节偏移量，inode，文件大小）
+        self.watcher = log_watch.LogWatcher()  # 日志变动监听
 
         self.verify_dict = {}  # 用于初始化时验证日志是否变动
 
-        self.error = {}  # 标记监控程序是否出现错误
-
-        # 初始化日志名称
-        self.init_col_names()
-
-        # 初始化日志条数
+        # 初始化日志名称，并监听日志文件的变动
         for name in self.log_directory:
-            self.log_len[name] = 0
+            self.watcher.watch(name)
+        self.watcher.watch_directory(r'/var/log/containers/')
+        self.init_col_names()
 
-        self.format_database()  # 格式化数据库
+        # 读取检查点，从上次的位置继续收集
+        self.checkpoint = None
+        positions = {}
+        if checkpoint_path:
+            self.checkpoint = log_checkpoint.Checkpoint(checkpoint_path, checkpoint_interval,
+                                                        (local_name, db_user, db_password, db_ip))
+            if not fresh:
+                positions = self.checkpoint.load()
+        self.registry.restore(positions)
+
+        # 数据库不可用时暂存日志的本地缓存
+        self.spool = None
+        if spool_directory:
+            self.spool = log_spool.LogSpool(spool_directory, max_size=spool_max_size)
+
+        # 仅在要求时格式化数据库；没有检查点时会从头收集日志，需要重新标注初始化时间
+        if fresh:
+            self.format_database()
+            if self.spool is not None:
+                self.spool.clear()
+        elif not positions:
+            print('no checkpoint found, collecting all logs from the beginning')
+            self.init_time()
+
+        # 后台批量上传日志
+        self.uploader = log_upload.LogUploader(local_name, db_user, db_password, db_ip, upload_queue_size,
+                                               upload_batch_size, upload_flush_interval, spool=self.spool,
+                                               consolidated=consolidated)
+        self.uploader.start()
+        if self.checkpoint is not None:
+            self.checkpoint.start()
 
     # -----------------------------------------初始化数据-----------------------------------------
     # *******************************************************************************************
@@ -77,7 +135,7 @@ class GetLog:
             if new_dir not in self.log_directory and new_dir[-4:] != '.swp':
                 print("检测到日志文件: ", new_dir)
                 self.log_directory.append(new_dir)
-                self.log_len[new_dir] = 0
+                self.watcher.watch(new_dir)
 
     # 初始化删库
     def format_database(self):
@@ -86,106 +144,99 @@ class GetLog:
         conn._delete()
         conn._insert_init_time()
 
+    # 标注初始化时间
+    def init_time(self):
+        conn = db_connect.DataBase(self.params['local_name'], self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'])
+        conn._insert_init_time()
+
     # ------------------------------------------其它操作------------------------------------------
     # *******************************************************************************************
 
-    # 检查日志是否变动
-    def check_log(self):
-        # 顺序检查每个日志文件
-        delay = 0
-        for seq in range(len(self.log_directory)):
-            local_log = []
-            try:
-                with open(self.log_directory[seq - delay], 'r+') as file:
-                    # 检查行数，看有无新增日志条目
-                    count = 0
-                    for index, line in enumerate(open(self.log_directory[seq - delay], 'r', errors='ignore')):
-                        count += 1
-                    diff = count - self.log_len[self.log_directory[seq - delay]]
-                    # 如果无新增，结束函数
-                    if diff == 0:
-                        pass
-                    # 如果出现新增，则追加日志
-                    elif diff > 0:
-                        local_log = self.get_log(seq - delay, 1)
-                    # 如果出现减少，则默认日志被重置，读取全部日志
-                    elif diff < 0:
-                        local_log = self.get_log(seq - delay, 0)
-                    # 对新日志进行判决并上传
-                    if local_log:
-                        self.judge_log(seq - delay, local_log)
-                        # 完成全部操作后，更新日志行数
-                        if self.error[str(self.log_directory[seq - delay])] == 0:
-                            self.log_len[self.log_directory[seq - delay]] = count
-            except FileNotFoundError:
-                print('%s no longer exists on this machine!')
-                del self.log_directory[seq - delay]
-                delay += 1
-
-    # 收集日志，seq为检索到的文件序号，option=0 时收集所有条目，option=1 时仅收集新生成的条目
-    def get_log(self, seq, option):
-        local_log = []
-        if option == 0:
-            with open(self.log_directory[seq], 'r+') as file:
-                for line in file:
-                    local_log.append(line.strip('\n'))
-
-        elif option == 1:
-            with open(self.log_directory[seq], 'r+') as file:
-                cnt = 0
-                for line in file:
-                    if cnt >= self.log_len[self.log_directory[seq]]:
-                        local_log.append(line.strip('\n'))
-                    cnt += 1
-        return local_log
-
-    # 判断日志紧急与否并上传日志, 参数为检索到的日志序号和待上传的日志条目列表
-    def judge_log(self, seq, local_log):
-        # 初始化
-        urgent_class_list = []  # 初始化单条日志的告警级别，0代表正常，1代表警告，2代表故障
-        id_list = []  # 初始化日志id
-        cnt = 0
-        # 生成日志id
-        for i in range(len(local_log)):
-            urgent_class_list.append(0)
-            id_list.append(str(time.time()) + str(cnt))
-            cnt += 1
-
-        # 进行告警判断
-        for i in range(len(local_log)):  # 按行判断
-            # 告警判断
-            # 1) 故障
-            for rule in self.judge_rule['error']:
-                if local_log[i].count(str(rule)):
-                    # 标记故障条目
-                    urgent_class_list[i] = 2
-            # 2) 警告
-            if urgent_class_list[i] == 0:
-                for rule in self.judge_rule['warn']:
-                    if local_log[i].count(str(rule)):
-                        # 标记告警条目
-                        urgent_class_list[i] = 1
-
-        # 把收集到的日志都丢到数据库里面
-        self.upload_log(seq, local_log, urgent_class_list, id_list)
-
-    # 上传日志到数据库，参数为检索到的日志序号，待上传的日志条目列表，告警级别
-    def upload_log(self, seq, local_log, urgent_class_list, id_list):
-        conn = db_connect.DataBase(self.params['local_name'], self.params['db_user'], self.params['db_password'],
-                                   self.params['db_ip'], 0)
-        upload_col_names = []
-        # 上传日志，将主机名+文件名作为表名
-        # 此处需控制地址长度在120字节内，以便作为数据库表名
-        if len(self.log_directory[seq]) > 40:
-            result = conn._insert(self.log_directory[seq][20:50] + str(hash(self.log_directory[seq][50:]))[:10],
-                                local_log, urgent_class_list, id_list)
+    # 检查日志是否变动，names为发生变动的日志地址集合，为None时检查所有日志
+    def check_log(self, names=None):
+        # 需要检查的日志文件序号
+        seq_list = [seq for seq in range(len(self.log_directory))
+                    if names is None or self.log_directory[seq] in names]
+        # 多个日志文件并行读取，同一文件内按顺序处理
+        if self.pool is not None and len(seq_list) > 1:
+            exist_list = list(self.pool.map(self.read_log, seq_list))
         else:
-            result = conn._insert(self.log_directory[seq], local_log, urgent_class_list, id_list)
-        # 上传情况报告
-        if result:
-            self.error[str(self.log_directory[seq])] = 1
+            exist_list = [self.read_log(seq) for seq in seq_list]
+        # 移除已不存在的日志文件（从后往前删除，避免序号变化）
+        for seq, exist in reversed(list(zip(seq_list, exist_list))):
+            if not exist:
+                name = self.log_directory[seq]
+                # 软链接仍在、只是指向的文件暂时不存在（日志轮转中），保留并等待新文件出现
+                if os.path.lexists(name):
+                    self.watcher.watch(name)
+                    continue
+                print('%s no longer exists on this machine!' % name)
+                del self.log_directory[seq]
+                self.registry.remove(name)
+                self.watcher.unwatch(name)
+        # 全量检查时，清理检查点中已不再读取的文件
+        if names is None and self.checkpoint is not None:
+            self.checkpoint.retain(self.registry.keys())
+
+    # 读取单个日志文件新增的日志，分块判决并交给上传线程，文件已不存在时返回0
+    def read_log(self, seq):
+        try:
+            for local_log, ack in self.get_log(seq):
+                if local_log:
+                    self.judge_log(seq, local_log, ack)
+                elif ack is not None:
+                    ack()
+        except FileNotFoundError:
+            return 0
+        return 1
+
+    # 收集日志，seq为检索到的文件序号，从上次的字节偏移量开始读取，仅收集新生成的条目
+    # 若文件被轮转，先收集旧文件剩余的条目；若文件被截断，则从头收集
+    # 这是一个生成器，每次最多读取chunk_size字节，生成(日志条目列表, 上传后的确认函数)
+    def get_log(self, seq):
+        name = self.log_directory[seq]
+        for cnt in range(self.chunk_count):
+            # 读取后立即更新日志偏移量（上传失败时由上传线程负责重试）
+            local_log, log_file = self.registry.read_chunk(name, self.chunk_size)
+            # 日志上传（或写入本地缓存）后，才推进检查点
+            ack = None
+            if self.checkpoint is not None:
+                ack = self.checkpoint.track(log_file.key, log_file.path, log_file.position)
+            yield local_log, ack
+            if not self.registry.has_more(name):
+                return
+        # 本轮未读完，下一轮立即继续读取
+        self.watcher.recheck.add(name)
+
+    # 判断日志紧急与否并上传日志, 参数为检索到的日志序号，待上传的日志条目列表，上传后的确认函数
+    def judge_log(self, seq, local_log, ack=None):
+        # 生成日志id：时间（精确到微秒）+ 进程内递增的6位序号，保证日志id唯一
+        time_id = '%.6f' % time.time()
+        id_list = [time_id + '%06d' % (next(self.id_counter) % 1000000) for cnt in range(len(local_log))]
+
+        # 进行告警判断，0代表正常，1代表警告，2代表故障
+        if self.judge == 1:
+            urgent_class_list = self.judger.judge_lines(local_log)
         else:
-            self.error[str(self.log_directory[seq])] = 0
+            urgent_class_list = [0] * len(local_log)
+
+        # 把收集到的日志都丢到数据库里面
+        self.upload_log(seq, local_log, urgent_class_list, id_list, ack)
+
+    # 上传日志到数据库，参数为检索到的日志序号，待上传的日志条目列表，告警级别，日志id，上传后的确认函数
+    # 数据包交给上传线程批量上传，上传线程积压时在此阻塞
+    def upload_log(self, seq, local_log, urgent_class_list, id_list, ack=None):
+        documents = db_connect.DataBase.build_documents(local_log, urgent_class_list, id_list)
+        self.uploader.put(self.get_col_name(self.log_directory[seq]), documents, ack)
+
+    # 将主机名+文件名作为表名
+    # 此处需控制地址长度在120字节内，以便作为数据库表名
+    # 使用固定的摘要算法（而不是每次启动都会变化的hash()），保证重启后写入同一张表
+    def get_col_name(self, name):
+        if len(name) > 40:
+            return name[20:50] + hashlib.md5(name[50:].encode('utf-8')).hexdigest()[:10]
+        return name
 
 def main(argv):
     ################# 自定义参数 #################
@@ -195,17 +246,20 @@ def main(argv):
     db_ip = ''
     db_user = ''
     db_password = ''
+    # 是否清空数据库从头收集
+    fresh = 0
     try:
-        opts, args = getopt.getopt(argv, "hi:o:", ["help", "local_name=", "db_ip=", 'db_user=', 'db_password='])
+        opts, args = getopt.getopt(argv, "hi:o:", ["help", "local_name=", "db_ip=", 'db_user=', 'db_password=',
+                                                   'fresh'])
     except getopt.GetoptError:
         print('usage:')
-        print('collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password>')
+        print('collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--fresh]')
         sys.exit(2)
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             print('usage:')
             print(
-                'collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password>')
+                'collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--fresh]')
             sys.exit()
         elif opt == "--local_name":
             local_name = str(arg)
@@ -215,34 +269,59 @@ def main(argv):
             db_user = str(arg)
         elif opt == "--db_password":
             db_password = str(arg)
+        elif opt == "--fresh":
+            fresh = 1
     # 检查参数完整性
     if local_name == '' or db_ip == '' or db_user == '' or db_password == '':
         print('invaild input')
         print('usage:')
-        print('collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password>')
+        print('collector.py --local_name <local_name> --db_ip <db_ip> --db_user <db_user> --db_password <db_password> [--fresh]')
         sys.exit()
 
     # 需要提取的日志的绝对地址
     log_directory = ['/var/log/messages']
 
     # 日志收集选项
-    time_lag = 1  # 单次查询的时间间隔，单位为秒。间隔越小对系统压力越大
+    time_lag = 1  # 轮询的时间间隔，单位为秒。仅在inotify不可用时使用，间隔越小对系统压力越大
     judge = 1  # 告警判断选项，0为不判断1为判断
+    judge_ignore_case = 1  # 告警规则是否忽略大小写
+    db_pool_size = 10  # 数据库连接池的最大连接数
+    upload_queue_size = 200  # 上传队列长度（每项最多chunk_size字节），队列占满时暂停读取日志
+    upload_batch_size = 5000  # 单批上传的日志条数
+    upload_flush_interval = 0.5  # 上传时间间隔，单位为秒
+    spool_directory = r'/var/lib/collector/spool'  # 数据库不可用时暂存日志的本地目录，为空时不使用本地缓存
+    spool_max_size = 1024 * 1024 * 1024  # 本地缓存大小上限，单位为字节
+    checkpoint_path = r'/var/lib/collector/checkpoint.json'  # 检查点文件地址，为空时不使用检查点，每次启动都从头收集
+    checkpoint_interval = 5  # 检查点保存间隔，单位为秒
+    chunk_size = 512 * 1024  # 单次读取的字节数上限，大文件分块读取、分块上传
+    chunk_count = 8  # 每个文件每轮最多读取的次数
+    read_workers = 4  # 并行读取日志的线程数，限制收集程序占用的CPU和磁盘IO，为1时顺序读取
+    consolidated = 0  # 存储方式，0为每个日志文件一张表，1为本机所有日志写入同一张合并表（日志文件很多时减少表的数量）
 
     # 告警规则，这是一个字典，字典的索引为故障级别，第二项为告警关键字
-    judge_rule = {'error': ['error', 'Error', 'ERROR', 'fail', 'fatal', 'Fatal', 'Critical', 'critical', 'CRITICAL'],
-                  "warn": ['Warn', 'warn']}
+    judge_rule = {'error': ['error', 'fail', 'fatal', 'critical'],
+                  "warn": ['warn']}
 
     ################# 开始循环监测 #################
 
+    # 设置数据库连接池
+    db_connect.configure_pool(maxPoolSize=db_pool_size)
+
     # 初始化收集日志
-    log_get = GetLog(local_name, db_ip, db_user, db_password, log_directory, judge, judge_rule)
+    log_get = GetLog(local_name, db_ip, db_user, db_password, log_directory, judge, judge_rule, judge_ignore_case,
+                     upload_queue_size, upload_batch_size, upload_flush_interval, spool_directory, spool_max_size,
+                     fresh, checkpoint_path, checkpoint_interval, chunk_size, chunk_count, read_workers, consolidated)
     # 主循环
     while 1:
-        # 定时检查日志
-        log_get.init_col_names()
-        log_get.check_log()
-        time.sleep(time_lag)
+        # 等待日志变动，inotify不可用时退化为定时轮询
+        changed = log_get.watcher.wait(time_lag)
+        # 全量检查
+        if changed is None:
+            log_get.init_col_names()
+            log_get.check_log()
+        # 只检查发生变动的日志
+        elif changed:
+            log_get.check_log(changed)
 
 
 if __name__ == '__main__':
@@ -5,26 +5,108 @@
 
 功能：
 被日志提取和日志处理程序调用，操作数据库
+同一进程内的DataBase实例共用以连接地址为索引的MongoClient（自带连接池），避免反复建立连接
+首次读写一张日志表时自动创建查询所需的索引，并检查查询计划，发现全表扫描（COLLSCAN）时输出提示
+插入日志的同时按(来源, 时间段, 告警级别)累加分钟和小时计数（汇总表），统计时读取小时汇总表，汇总表建立之前的时间段对日志表进行聚合查询；分钟汇总表供按分钟统计的接口读取
+可选合并存储：每个节点的所有日志来源写入同一张合并表，以source字段区分来源，避免日志文件多时产生大量的表
 '''
 
-import json, time
-from pymongo import MongoClient
+import json, time, os, datetime
+import threading
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from dateutil import parser
 import gridfs
 
 
+# 连接池参数，可通过configure_pool修改，仅对之后新建的连接生效
+POOL_OPTIONS = {
+    'maxPoolSize': 100,  # 每个数据库地址的最大连接数
+    'minPoolSize': 0,  # 保持的最小连接数
+    'maxIdleTimeMS': 300000,  # 空闲连接的最长保留时间
+    'connectTimeoutMS': 10000,  # 建立连接的超时时间
+    'socketTimeoutMS': 60000,  # 单次读写的超时时间
+    'serverSelectionTimeoutMS': 10000,  # 数据库不可用时的等待时间
+    'waitQueueTimeoutMS': 30000,  # 连接池耗尽时的等待时间
+}
+
+# 日志表的索引：日志id唯一，按告警级别+时间查询，按时间排序
+LOG_INDEXES = [
+    ([('log id', 1)], {'unique': True}),
+    ([('urgent class', 1), ('time', -1)], {}),
+    ([('time', -1)], {}),
+]
+# 合并存储时的日志表（每个数据库即节点一张）及其索引，查询时均按来源筛选
+CONSOLIDATED_COLLECTION = '[logs]'
+CONSOLIDATED_INDEXES = [
+    ([('log id', 1)], {'unique': True}),
+    ([('source', 1), ('time', -1)], {}),
+    ([('source', 1), ('urgent class', 1), ('time', -1)], {}),
+    ([('source', 1), ('_id', -1)], {}),
+]
+
+# 汇总表：时间粒度 -> (表名, 时间段格式)，每个数据库（节点）一张，按(来源, 时间段, 告警级别)计数
+ROLLUP_COLLECTIONS = {
+    'minute': ('[rollup minute]', '%Y-%m-%d-%H-%M'),
+    'hour': ('[rollup hour]', '%Y-%m-%d-%H'),
+}
+# 所有汇总表的表名，不作为日志表读取
+ROLLUP_NAMES = [rollup[0] for rollup in ROLLUP_COLLECTIONS.values()]
+ROLLUP_INDEXES = [
+    ([('source', 1), ('date', -1)], {}),
+    ([('date', -1)], {}),
+]
+REQUEST_BATCH_SIZE = 5000  # 按日志id批量查询时，每次查询的id数量上限
+INDEXED = set()  # 已创建索引的(连接地址, 数据库名, 表名)
+PLAN_CHECKED = set()  # 已检查过查询计划的(连接地址, 数据库名, 表名, 查询名)
+REPLAY_MARK_TTL = 24 * 3600  # 补传标注的保留时间（秒），过期后由数据库删除
+
+CLIENTS = {}  # 连接地址 -> MongoClient
+CLIENTS_PID = os.getpid()  # 创建连接的进程号，fork后的子进程不能沿用父进程的连接
+CLIENTS_LOCK = threading.Lock()
+
+
+# 修改连接池参数，参数名同POOL_OPTIONS
+def configure_pool(**options):
+    POOL_OPTIONS.update(options)
+
+
+# 获取指定连接地址的MongoClient，同一进程内共用
+def get_client(uri):
+    global CLIENTS, CLIENTS_PID
+    with CLIENTS_LOCK:
+        if CLIENTS_PID != os.getpid():
+            CLIENTS = {}
+            CLIENTS_PID = os.getpid()
+        client = CLIENTS.get(uri)
+        if client is None:
+            client = MongoClient(uri, **POOL_OPTIONS)
+            CLIENTS[uri] = client
+        return client
+
+
+# 关闭所有连接
+def close_clients():
+    with CLIENTS_LOCK:
+        for client in CLIENTS.values():
+            client.close()
+        CLIENTS.clear()
+
 
 # 数据库操作
 class DataBase:
-    # 输入数据库名，用户，密码，ip，数据库选项（=0直接使用数据库，=1使用gridfs），检索选项（=1时检索数据库名）
-    def __init__(self, db_name, usr, passwd, ip, use_gridfs = 0, check = 0):
-        # 建立连接
-        self.db_connect = MongoClient('mongodb://%s:%s@%s' % (usr, passwd, ip))
+    # 输入数据库名，用户，密码，ip，数据库选项（=0直接使用数据库，=1使用gridfs），检索选项（=1时检索数据库名），
+    # 存储选项（=0每个日志来源一张表，=1所有来源写入合并表，此时各方法的表名参数表示日志来源）
+    def __init__(self, db_name, usr, passwd, ip, use_gridfs = 0, check = 0, consolidated = 0):
+        # 获取共用的连接
+        self.uri = 'mongodb://%s:%s@%s' % (usr, passwd, ip)
+        self.db_connect = get_client(self.uri)
         if check == 1:
             return
 
         self.db = self.db_connect[db_name]
         self.db_name = db_name
+        self.consolidated = consolidated
 
         # 直接使用数据库
         if use_gridfs == 0:
@@ -35,15 +117,68 @@ class DataBase:
             self.fs = gridfs.GridFS(self.db)
 
 
-    # 向指定的表插入数据
-    # 输入的参数为：表名，待上传的数据列表，告警级别列表，日志id
-    def _insert(self, col_name, data, urgent_class_list, id_list):
-        # 检查格式是否正确
-        if len(data) != len(urgent_class_list) != len(id_list):
-            print('input error: all list must have same length!')
-            return 1
-        # 计时
-        time_start = time.time()
+    # 为日志表（或汇总表）创建索引，每个进程对每张表只执行一次（索引已存在时数据库直接返回）
+    # 由首次读写该表的请求执行，表中已有大量数据时该请求需等待索引建立完成
+    # 已有重复日志id的旧表无法建立唯一索引，改为普通索引，只有新表按日志id去重；创建失败的索引不再重试
+    def ensure_indexes(self, col_name, indexes=LOG_INDEXES):
+        key = (self.uri, self.db_name, col_name)
+        if key in INDEXED:
+            return
+        for keys, options in indexes:
+            try:
+                self.db[col_name].create_index(keys, background=True, **options)
+            except (DuplicateKeyError, OperationFailure) as e:
+                if not options.get('unique'):
+                    print('create index %s on %s.%s failed: %s' % (keys, self.db_name, col_name, e))
+                    continue
+                print('unique index %s on %s.%s failed, using a non-unique index: %s' % (keys, self.db_name, col_name, e))
+                options = {name: options[name] for name in options if name != 'unique'}
+                try:
+                    self.db[col_name].create_index(keys, background=True, **options)
+                except OperationFailure as e:
+                    print('create index %s on %s.%s failed: %s' % (keys, self.db_name, col_name, e))
+        INDEXED.add(key)
+
+    # 返回日志所在的表和查询条件，并确保该表已创建索引
+    # 合并存储时返回合并表，查询条件中加入来源（col_name为None时不筛选来源）
+    def log_collection(self, col_name, query=None):
+        query = dict(query or {})
+        if not self.consolidated:
+            self.ensure_indexes(col_name)
+            return self.db[col_name], query
+        self.ensure_indexes(CONSOLIDATED_COLLECTION, CONSOLIDATED_INDEXES)
+        if col_name is not None:
+            query['source'] = col_name
+        return self.db[CONSOLIDATED_COLLECTION], query
+
+    # 检查查询计划，查询使用全表扫描（COLLSCAN）时输出提示，每个进程对每张表的每种查询只检查一次
+    # 输入的参数为：表名，查询名（用于去重和提示），查询条件，排序条件
+    def check_query_plan(self, col_name, query_name, query, sort=None):
+        key = (self.uri, self.db_name, col_name, query_name)
+        if key in PLAN_CHECKED:
+            return
+        PLAN_CHECKED.add(key)
+        cursor = self.db[col_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            plan = cursor.explain()['queryPlanner']['winningPlan']
+        except Exception as e:
+            print('explain %s.%s failed: %s' % (self.db_name, col_name, e))
+            return
+        # 遍历查询计划的各个阶段
+        stages = []
+        while plan:
+            stages.append(plan.get('stage'))
+            plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+        if 'COLLSCAN' in stages:
+            print('warning: query %s on %s.%s uses a collection scan (%s)' %
+                  (query_name, self.db_name, col_name, ' <- '.join(stages)))
+
+    # 生成待上传的数据包
+    # 输入的参数为：待上传的数据列表，告警级别列表，日志id
+    @staticmethod
+    def build_documents(data, urgent_class_list, id_list):
         time_request = parser.parse(time.strftime("%Y-%m-%d %H:%M:%S"))
         upload_dict = []
         for seq in range(len(id_list)):
@@ -55,8 +190,19 @@ class DataBase:
             request_dict['data'] = data[seq]
             # 保存
             upload_dict.append(request_dict)
+        return upload_dict
+
+    # 向指定的表插入数据
+    # 输入的参数为：表名，待上传的数据列表，告警级别列表，日志id
+    def _insert(self, col_name, data, urgent_class_list, id_list):
+        # 检查格式是否正确
+        if not len(data) == len(urgent_class_list) == len(id_list):
+            print('input error: all list must have same length!')
+            return 1
+        # 计时
+        time_start = time.time()
         # 上传
-        up = self.db[col_name].insert_many(upload_dict)
+        self._insert_documents(col_name, self.build_documents(data, urgent_class_list, id_list))
         time_stop = time.time()
         print(col_name)
 
@@ -64,6 +210,51 @@ class DataBase:
               (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), len(data), time_stop-time_start))
         return 0
 
+    # 向指定的表批量插入已生成的数据包，不保证插入顺序，以便数据库并行写入
+    # 重试时已经插入过的数据包会产生重复键错误，视为插入成功
+    # 插入后累加汇总表，重复的数据包不计数
+    def _insert_documents(self, col_name, documents):
+        if not documents:
+            return
+        collection, _ = self.log_collection(col_name)
+        if self.consolidated:
+            for document in documents:
+                document['source'] = col_name
+        inserted = documents
+        try:
+            collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])) or \
+                    e.details.get('writeConcernErrors'):
+                raise
+            duplicated = set(error['index'] for error in e.details['writeErrors'])
+            inserted = [documents[seq] for seq in range(len(documents)) if seq not in duplicated]
+        # 日志已经写入，汇总表更新失败时只影响统计，不再重试（避免重复计数）
+        try:
+            self._update_rollups(col_name, inserted)
+        except Exception as e:
+            print('update rollups of %s.%s failed: %s' % (self.db_name, col_name, e))
+
+    # 按(来源, 时间段, 告警级别)累加汇总表的计数，每个时间粒度一次批量写入
+    def _update_rollups(self, col_name, documents):
+        counts = {}
+        for document in documents:
+            for granularity in ROLLUP_COLLECTIONS:
+                bucket = document['time'].strftime(ROLLUP_COLLECTIONS[granularity][1])
+                key = (granularity, bucket, document['urgent class'])
+                counts[key] = counts.get(key, 0) + 1
+        requests = {}
+        for (granularity, bucket, urgent_class), count in counts.items():
+            requests.setdefault(granularity, []).append(UpdateOne(
+                {'_id': {'source': col_name, 'date': bucket, 'urgent class': urgent_class}},
+                {'$inc': {'count': count},
+                 '$setOnInsert': {'source': col_name, 'date': bucket, 'urgent class': urgent_class}},
+                upsert=True))
+        for granularity in requests:
+            rollup_name = ROLLUP_COLLECTIONS[granularity][0]
+            self.ensure_indexes(rollup_name, ROLLUP_INDEXES)
+            self.db[rollup_name].bulk_write(requests[granularity], ordered=False)
+
     # 保存初始化时间（程序启动时会用启动的时间表示日志生成时间，为了避免这些日期影响分析程序，所以要进行启动时间标注
     def _insert_init_time(self):
         # 首先，删除原来的数据
@@ -111,45 +302,98 @@ class DataBase:
     def _request(self, col_name, id_list = []):
         # print('request begin: %s  %s'%(self.db_name, col_name))
         return_list = []
-        # 返回指定id的数据
+        collection, query = self.log_collection(col_name)
+        # 返回指定id的数据，按请求的顺序排列，不存在的id不返回
         if id_list:
+            self.check_query_plan(collection.name, 'log id', dict(query, **{"log id": id_list[0]}))
+            found = {}
+            for data in self._iter_request(col_name, id_list):
+                found[data['log id']] = data
             for id in id_list:
-                return_list.append(self.db[col_name].find_one({"log id": id},{"_id": 0}))
+                if id in found:
+                    return_list.append(found[id])
         # 返回所有数据
         else:
-            for data in self.db[col_name].find({},{"_id": 0}):
+            for data in collection.find(query, {"_id": 0}):
             # 将查询到的所有数据读入read_dict字典
                 print(data)
                 return_list.append(data)
         return return_list
 
+    # 按日志id批量查询日志，每批id只查询一次（$in），返回值为可迭代的查询结果，顺序不定
+    def _iter_request(self, col_name, id_list, batch_size=REQUEST_BATCH_SIZE):
+        collection, query = self.log_collection(col_name)
+        for start in range(0, len(id_list), batch_size):
+            batch_query = dict(query, **{'log id': {'$in': id_list[start:start + batch_size]}})
+            for data in collection.find(batch_query, {"_id": 0}):
+                yield data
+
     # 请求详细数据（只选取其中的100条）
-    def _request_detail(self, col_name, urgent_class=-1, limit=100):
+    # max_id不为None时，只查询_id不大于max_id的日志（与_request_new配合，保证增量查询不重不漏）
+    def _request_detail(self, col_name, urgent_class=-1, limit=100, max_id=None):
         # 查询的结果形如：{'log id': '1597621166.121952510', 'time': datetime.datetime(2020, 8, 17, 7, 39, 26), 'urgent class': 2}
         # 返回值是多个查询结果组成的列表
         # print('request begin: %s  %s' % (self.db_name, col_name))
         return_list = []
+        collection, query = self.log_collection(col_name)
+        if max_id is not None:
+            query['_id'] = {'$lte': max_id}
         # 选取所有对应告警级别的日志
         if urgent_class > -1:
-            for data in self.db[col_name].find({'urgent class': urgent_class},
-                                               {"_id": 0, 'data': 0}).sort([("time", -1)]):
+            query['urgent class'] = urgent_class
+            self.check_query_plan(collection.name, 'urgent class', query, [("time", -1)])
+            for data in collection.find(query, {"_id": 0, 'data': 0}).sort([("time", -1)]):
                 # 将查询到的所有数据读入read_dict字典
                 return_list.append(data)
         # 选取指定数量日志
         elif limit > 0:
-            for data in self.db[col_name].find({}, {"_id": 0, 'data':0}).sort([("time", -1)]).limit(limit):
+            for data in collection.find(query, {"_id": 0, 'data':0}).sort([("time", -1)]).limit(limit):
                 # 将查询到的所有数据读入read_dict字典
                 return_list.append(data)
         # 选取所有日志
         else:
-            for data in self.db[col_name].find({}, {"_id": 0, 'data':0}).sort([("time", -1)]):
+            for data in collection.find(query, {"_id": 0, 'data':0}).sort([("time", -1)]):
                 # 将查询到的所有数据读入read_dict字典
                 return_list.append(data)
         return return_list
 
-    # 请求统计数据
-    def _request_statistics(self, col_name):
-
+    # 请求_id大于min_id（inclusive为真时不小于min_id）的新日志（不含日志内容），按_id升序排列，返回值中包含_id，用作下次查询的起点
+    # min_id为None时返回所有日志；合并存储时col_name为None表示该节点所有来源的日志
+    def _request_new(self, col_name, min_id, inclusive=False):
+        collection, query = self.log_collection(col_name)
+        if min_id is not None:
+            query['_id'] = {'$gte' if inclusive else '$gt': min_id}
+        return list(collection.find(query, {'data': 0}).sort([("_id", 1)]))
+
+    # 请求最新一条日志的_id，表为空时返回None；合并存储时col_name为None表示该节点所有来源的日志
+    def _request_last_id(self, col_name):
+        collection, query = self.log_collection(col_name)
+        data = collection.find_one(query, {'_id': 1}, sort=[("_id", -1)])
+        if data:
+            return data['_id']
+        return None
+
+    # 请求统计数据，优先读取小时汇总表，max_id不为None时只统计_id不大于max_id的日志（只对聚合查询有效）
+    # 汇总表只包含升级后写入的日志：最早的汇总时间段（升级时所在的小时）及之前的统计对日志表进行聚合查询
+    def _request_statistics(self, col_name, max_id=None):
+        start = self._request_rollup_start(col_name)
+        if start is None:
+            return self._aggregate_statistics(col_name, max_id)
+        return_list = [data for data in self._request_rollup(col_name, 'hour') if data['_id']['date'] != start]
+        until = datetime.datetime.strptime(start, ROLLUP_COLLECTIONS['hour'][1]) + datetime.timedelta(hours=1)
+        return return_list + self._aggregate_statistics(col_name, max_id, until)
+
+    # 小时汇总表中一个来源最早的时间段，没有汇总数据时返回None
+    def _request_rollup_start(self, col_name):
+        rollup_name, _ = ROLLUP_COLLECTIONS['hour']
+        self.ensure_indexes(rollup_name, ROLLUP_INDEXES)
+        data = self.db[rollup_name].find_one({'source': col_name}, {'date': 1}, sort=[('date', 1)])
+        if data:
+            return data['date']
+        return None
+
+    # 对日志表进行聚合查询，按小时和告警级别计数，since、until不为None时只统计时间在[since, until)内的日志
+    def _aggregate_statistics(self, col_name, max_id=None, until=None, since=None):
         # ***************
         # 进行查询，查询语句pipeline中group代表查询格式，'_id'表示查询的内容，'count'表示计数
         # 查询的结果格式为：{'_id': {'date': '2020-08-17-07', 'urgent class': 2}, 'count': 3}
@@ -160,16 +404,70 @@ class DataBase:
         # ***************
 
         return_list = []
+        collection, query = self.log_collection(col_name)
         pipeline = [
             {'$group': {
                 '_id': {'date': {"$dateToString": {'format': '%Y-%m-%d-%H', 'date': '$time'}}, 'urgent class': '$urgent class'},
                 'count': {'$sum': 1}}},
             {'$sort': {"_id": -1}}
         ]
-        for result in self.db[col_name].aggregate(pipeline):
+        if max_id is not None:
+            query['_id'] = {'$lte': max_id}
+        if since is not None or until is not None:
+            query['time'] = {}
+            if since is not None:
+                query['time']['$gte'] = since
+            if until is not None:
+                query['time']['$lt'] = until
+        if query:
+            pipeline.insert(0, {'$match': query})
+        for result in collection.aggregate(pipeline):
             return_list.append(result)
         return return_list
 
+    # 读取汇总表，返回值格式与_request_statistics相同（_id中另有来源source），按时间倒序排列
+    # 输入的参数为：表名（为None时读取该节点所有来源），时间粒度（minute或hour），
+    # 起始时间段、结束时间段（均包含，为None时不限制）
+    def _request_rollup(self, col_name, granularity='hour', since=None, until=None):
+        rollup_name, _ = ROLLUP_COLLECTIONS[granularity]
+        self.ensure_indexes(rollup_name, ROLLUP_INDEXES)
+        query = {}
+        if col_name is not None:
+            query['source'] = col_name
+        if since is not None or until is not None:
+            query['date'] = {}
+            if since is not None:
+                query['date']['$gte'] = since
+            if until is not None:
+                query['date']['$lte'] = until
+        return_list = []
+        for data in self.db[rollup_name].find(query).sort([('date', -1)]):
+            return_list.append({'_id': {'date': data['date'], 'urgent class': data['urgent class'],
+                                        'source': data['source']},
+                                'count': data['count']})
+        return return_list
+
+    # 获取合并表中的所有日志来源
+    def get_sources(self, db_name=''):
+        db = self.db_connect[db_name] if db_name else self.db
+        return db[CONSOLIDATED_COLLECTION].distinct('source')
+
+    # 判断日志来源是否存储在合并表中（数据库中有合并表，且没有与来源同名的表）
+    def is_consolidated(self, col_name):
+        names = self.db.list_collection_names(filter={'name': {'$in': [col_name, CONSOLIDATED_COLLECTION]}})
+        return col_name not in names and CONSOLIDATED_COLLECTION in names
+
+    # 订阅所有节点数据库的新日志（change stream，需要副本集部署），返回值为可迭代的推送流
+    # 推送内容不含日志内容；resume_after为上次中断处的恢复标记
+    def _watch_inserts(self, resume_after=None):
+        pipeline = [
+            {'$match': {'operationType': 'insert',
+                        'ns.db': {'$nin': ['admin', 'config', 'local', 'init_time']},
+                        'ns.coll': {'$nin': ROLLUP_NAMES}}},
+            {'$project': {'fullDocument.data': 0}}
+        ]
+        return self.db_connect.watch(pipeline, resume_after=resume_after)
+
     # 查询初始化时间（程序启动时会用启动的时间表示日志生成时间，为了避免这些日期影响分析程序，所以要进行启动时间标注
     def check_init_time(self):
         # 存储的数据库为init_time
@@ -178,6 +476,48 @@ class DataBase:
             return_dict[data['machine']] = data['init time']
         return return_dict
 
+    # 查询初始化时间的变动标记（最新一条记录的_id），有collector重新标注初始化时间后改变，没有记录时返回None
+    def check_init_time_mark(self):
+        data = self.db_connect['init_time']['init_time'].find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        if data:
+            return data['_id']
+        return None
+
+    # 标注本节点有日志从本地缓存补传，min_ids为{表名（合并存储时为日志来源）: 补传日志中最小的_id}
+    # 补传的日志时间较早，_id可能小于日志处理程序已读取的高水位，日志处理程序据此重新查询_id不小于该值的日志
+    def _mark_replay(self, min_ids):
+        collection = self.db_connect['init_time']['replay']
+        collection.create_index([('time', 1)], expireAfterSeconds=REPLAY_MARK_TTL)
+        collection.insert_one({'machine': self.db_name, 'time': datetime.datetime.utcnow(),
+                               'sources': [{'source': col_name, 'min id': min_ids[col_name]}
+                                           for col_name in sorted(min_ids)]})
+
+    # 查询_id大于min_id的补传标注（min_id为None时查询全部），按_id升序排列
+    def check_replays(self, min_id):
+        query = {}
+        if min_id is not None:
+            query['_id'] = {'$gt': min_id}
+        return list(self.db_connect['init_time']['replay'].find(query).sort([('_id', 1)]))
+
+    # 查询补传标注的起点（最新一条记录的_id），没有记录时返回None
+    def check_replay_mark(self):
+        data = self.db_connect['init_time']['replay'].find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        if data:
+            return data['_id']
+        return None
+
+    # 保存检查点（各日志文件已上传的字节偏移量），与初始化时间一同存储在init_time数据库中
+    def _save_checkpoint(self, files):
+        self.db_connect['init_time']['checkpoint'].replace_one({'machine': self.db_name},
+                                                               {'machine': self.db_name, 'files': files}, upsert=True)
+
+    # 读取检查点，返回值形如{'dev:inode': {'path': 日志地址, 'offset': 字节偏移量}}
+    def _load_checkpoint(self):
+        data = self.db_connect['init_time']['checkpoint'].find_one({'machine': self.db_name}, {'_id': 0})
+        if data:
+            return data['files']
+        return {}
+
     # 删除数据库
     def _delete(self):
         self.db.command("dropDatabase")
@@ -0,0 +1,246 @@
+# coding:utf-8
+
+'''
+异常日志缓冲类
+
+功能：
+被日志处理程序调用，按时间顺序保存异常日志，新日志到达时增量加入
+1. 按列存储：时间为datetime64数组，告警级别为int8数组，节点名和日志来源为整数编码（编码表全局共用），日志id为定长字节串数组，
+   与每条日志一个字典相比占用的内存少一个数量级，也不会产生大量需要垃圾回收的对象
+2. 日志按(时间, 日志id)排序，查询最新的N条日志时直接截取末尾，查询某一时间之后的日志和分页查询时二分查找，
+   按告警级别、按节点各自的起始时间筛选时向量化比较，只有查询结果才转换为字典
+3. 保存的日志条数有上限，超过上限时丢弃最早的日志
+'''
+
+import threading
+import numpy as np
+
+# 日志中的字段
+FIELDS = ['log id', 'time', 'urgent class', 'machine', 'source']
+
+
+# 字符串编码表，将节点名、日志来源等重复出现的字符串转为整数编码
+class StringTable:
+    def __init__(self):
+        self.values = []  # 编码 -> 字符串
+        self.codes = {}  # 字符串 -> 编码
+        self.lock = threading.Lock()
+
+    # 字符串的编码，新字符串分配新编码
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            with self.lock:
+                code = self.codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+
+MACHINES = StringTable()  # 节点名编码表
+SOURCES = StringTable()  # 日志来源编码表
+
+
+class ErrorBuffer:
+    # 输入参数为：保存的日志条数上限（为0时不限制）
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0  # 保存的日志条数，各列数组的长度为容量，只有前size项有效
+        self.columns = self.empty_columns(0)
+        self.lock = threading.Lock()
+
+    # 保存的日志条数
+    def __len__(self):
+        return self.size
+
+    # 生成空的各列数组
+    @staticmethod
+    def empty_columns(capacity, id_width=1):
+        return {'time': np.zeros(capacity, dtype='datetime64[us]'),
+                'urgent class': np.zeros(capacity, dtype=np.int8),
+                'machine': np.zeros(capacity, dtype=np.int32),
+                'source': np.zeros(capacity, dtype=np.int32),
+                'log id': np.zeros(capacity, dtype='S%s' % id_width)}
+
+    # 将日志（字典列表）转为各列数组，按(时间, 日志id)排序
+    @staticmethod
+    def to_columns(data_list):
+        columns = {'time': np.array([data['time'] for data in data_list], dtype='datetime64[us]'),
+                   'urgent class': np.array([data['urgent class'] for data in data_list], dtype=np.int8),
+                   'machine': np.array([MACHINES.code(data['machine']) for data in data_list], dtype=np.int32),
+                   'source': np.array([SOURCES.code(data['source']) for data in data_list], dtype=np.int32),
+                   'log id': np.array([data['log id'].encode('utf-8') for data in data_list], dtype=np.bytes_)}
+        order = np.lexsort((columns['log id'], columns['time']))
+        for field in columns:
+            columns[field] = columns[field][order]
+        return columns
+
+    # 加入日志（字典列表）
+    # 日志大多按时间顺序到达，直接追加到末尾（容量不足时翻倍）；有更早的日志时与已有日志一起重新排序
+    def extend(self, data_list):
+        if not data_list:
+            return
+        new_columns = self.to_columns(data_list)
+        count = len(data_list)
+        with self.lock:
+            columns = self.columns
+            last = (columns['time'][self.size - 1], columns['log id'][self.size - 1]) if self.size else None
+            if last is not None and (new_columns['time'][0], new_columns['log id'][0]) < last:
+                self.set_columns(self.concat([{field: columns[field][:self.size] for field in columns},
+                                              new_columns]))
+            else:
+                # 日志id变长时加宽日志id列
+                if new_columns['log id'].itemsize > columns['log id'].itemsize:
+                    columns['log id'] = columns['log id'].astype(new_columns['log id'].dtype)
+                if self.size + count > len(columns['time']):
+                    capacity = max(self.size + count, len(columns['time']) * 2, 16)
+                    grown = self.empty_columns(capacity, columns['log id'].itemsize)
+                    for field in columns:
+                        grown[field][:self.size] = columns[field][:self.size]
+                    columns = self.columns = grown
+                for field in columns:
+                    columns[field][self.size:self.size + count] = new_columns[field]
+                self.size += count
+            self.trim()
+
+    # 替换全部数据（各列数组已按(时间, 日志id)排序）
+    def set_columns(self, columns):
+        self.columns = columns
+        self.size = len(columns['time'])
+
+    # 超过上限时丢弃最早的日志
+    def trim(self):
+        if self.max_size and self.size > self.max_size:
+            self.set_columns({field: self.columns[field][self.size - self.max_size:self.size].copy()
+                              for field in self.columns})
+
+    # 拼接多组各列数组并按(时间, 日志id)排序
+    @staticmethod
+    def concat(columns_list):
+        columns = {}
+        for field in FIELDS:
+            columns[field] = np.concatenate([item[field] for item in columns_list])
+        order = np.lexsort((columns['log id'], columns['time']))
+        for field in columns:
+            columns[field] = columns[field][order]
+        return columns
+
+    # 合并多个ErrorBuffer，返回值为新的ErrorBuffer
+    @classmethod
+    def merge(cls, buffers, max_size=0):
+        merged = cls(max_size)
+        columns_list = []
+        for buffer in buffers:
+            with buffer.lock:
+                if buffer.size:
+                    columns_list.append({field: buffer.columns[field][:buffer.size] for field in buffer.columns})
+        if columns_list:
+            merged.set_columns(cls.concat(columns_list))
+            merged.trim()
+        return merged
+
+    # 导出保存的日志（各列数组，节点名和日志来源为编码），用于保存快照
+    def dump(self):
+        with self.lock:
+            return {field: self.columns[field][:self.size] for field in FIELDS}
+
+    # 由快照中的各列数组生成ErrorBuffer，machines、sources为保存快照时的编码表，节点名和日志来源按当前编码表重新编码
+    @classmethod
+    def load(cls, columns, machines, sources, max_size=0):
+        buffer = cls(max_size)
+        columns = dict(columns)
+        for field, table, values in (('machine', MACHINES, machines), ('source', SOURCES, sources)):
+            codes = np.array([table.code(value) for value in values], dtype=np.int32)
+            columns[field] = codes[columns[field]]
+        buffer.set_columns(columns)
+        buffer.trim()
+        return buffer
+
+    # 各日志id是否已在缓冲中，返回值为布尔数组
+    def contains(self, log_ids):
+        with self.lock:
+            return np.isin(np.array([log_id.encode('utf-8') for log_id in log_ids], dtype=np.bytes_),
+                           self.columns['log id'][:self.size])
+
+    # 将选中的日志转为字典列表，index为按时间排序的序号数组
+    def to_dicts(self, index):
+        columns = self.columns
+        times = columns['time'][index].astype(object)
+        urgent_classes = columns['urgent class'][index].tolist()
+        machines = columns['machine'][index].tolist()
+        sources = columns['source'][index].tolist()
+        log_ids = columns['log id'][index].tolist()
+        return_list = []
+        for seq in range(len(times)):
+            return_list.append({'log id': log_ids[seq].decode('utf-8'), 'time': times[seq],
+                                'urgent class': urgent_classes[seq], 'machine': MACHINES.values[machines[seq]],
+                                'source': SOURCES.values[sources[seq]]})
+        return return_list
+
+    # 序号在[start, end)内、告警级别在classes中的日志序号，classes为None时不筛选，end为None时到末尾
+    def class_index(self, classes, start=0, end=None):
+        if end is None:
+            end = self.size
+        if classes is None:
+            return np.arange(start, end)
+        return start + np.flatnonzero(np.isin(self.columns['urgent class'][start:end], classes))
+
+    # 最新的n条日志，按时间排序，classes为告警级别列表（为None时不筛选）
+    def latest(self, n, classes=None):
+        if n <= 0:
+            return []
+        with self.lock:
+            return self.to_dicts(self.class_index(classes)[-n:])
+
+    # 时间晚于since的日志，按时间排序；since为None时返回全部日志
+    def since(self, since=None, classes=None):
+        with self.lock:
+            start = 0
+            if since is not None:
+                start = int(np.searchsorted(self.columns['time'][:self.size], np.datetime64(since, 'us'),
+                                            side='right'))
+            return self.to_dicts(self.class_index(classes, start))
+
+    # 按节点分别筛选时间晚于各自起始时间的日志，按时间排序
+    # cutoffs为{节点名: 起始时间}，不在cutoffs中的节点不筛选；各节点的起始时间转为按节点编码索引的数组，一次向量化比较
+    def since_each(self, cutoffs, classes=None):
+        with self.lock:
+            codes = {MACHINES.code(machine): cutoffs[machine] for machine in cutoffs}
+            thresholds = np.full(len(MACHINES.values), np.datetime64('NaT'), dtype='datetime64[us]')
+            for code in codes:
+                thresholds[code] = np.datetime64(codes[code], 'us')
+            index = self.class_index(classes)
+            limits = thresholds[self.columns['machine'][index]]
+            keep = np.isnat(limits) | (self.columns['time'][index] > limits)
+            return self.to_dicts(index[keep])
+
+    # 分页查询：时间在[since, until)内、(时间, 日志id)小于cursor的最新的limit条日志，按时间倒序
+    # since、until为None时不限制，cursor为上一页返回的(时间, 日志id)，为None时从最新的日志开始
+    # 返回值为(日志字典列表, 下一页的cursor，没有下一页时为None)
+    def page(self, since=None, until=None, cursor=None, limit=100, classes=None):
+        with self.lock:
+            times = self.columns['time'][:self.size]
+            start = 0
+            end = self.size
+            if since is not None:
+                start = int(np.searchsorted(times, np.datetime64(since, 'us'), side='left'))
+            if until is not None:
+                end = int(np.searchsorted(times, np.datetime64(until, 'us'), side='left'))
+            if cursor is not None:
+                # 时间相同的日志按日志id排序，在其中再二分查找
+                cursor_time = np.datetime64(cursor[0], 'us')
+                left = int(np.searchsorted(times, cursor_time, side='left'))
+                right = int(np.searchsorted(times, cursor_time, side='right'))
+                position = left + int(np.searchsorted(self.columns['log id'][left:right], cursor[1].encode('utf-8'),
+                                                      side='left'))
+                end = min(end, position)
+            if end <= start:
+                return [], None
+            index = self.class_index(classes, start, end)
+            more = len(index) > limit
+            return_list = self.to_dicts(index[len(index) - limit if more else 0:][::-1])
+        if more and return_list:
+            return return_list, (return_list[-1]['time'], return_list[-1]['log id'])
+        return return_list, None
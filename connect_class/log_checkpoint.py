@@ -0,0 +1,116 @@
+# coding:utf-8
+
+'''
+日志检查点类
+
+功能：
+被日志收集程序调用，定时保存每个日志文件（以设备号和inode标识）已上传的字节偏移量，程序重启后从检查点继续读取
+1. 只有已写入数据库或本地缓存的日志才会计入检查点，队列中尚未上传的日志不会被跳过
+2. 检查点保存在本地文件中，同时备份到数据库的init_time库，本地文件丢失时从数据库恢复
+'''
+
+import os
+import json
+import time
+import threading
+
+# 数据库连接类
+from connect_class import db_connect
+
+
+class Checkpoint(threading.Thread):
+    # 输入参数为：本地检查点文件地址，保存间隔（秒），数据库连接参数（本机名，数据库用户，数据库密码，数据库ip，为None时只保存在本地）
+    def __init__(self, path, interval=5, db_params=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.interval = interval
+        self.db_params = db_params
+
+        self.files = {}  # 'dev:inode' -> {'path': 日志地址, 'offset': 已上传的字节偏移量}
+        self.pending = {}  # 'dev:inode' -> 尚未上传的[字节偏移量, 是否已上传]列表，按读取顺序排列
+        self.dirty = 0  # 检查点是否有未保存的变动
+        self.lock = threading.Lock()
+
+    # 读取检查点，返回值为{(设备号, inode): 字节偏移量}
+    def load(self):
+        files = {}
+        try:
+            with open(self.path, 'r') as file:
+                files = json.load(file)
+            print('checkpoint loaded from %s' % self.path)
+        except (OSError, ValueError) as e:
+            print('local checkpoint unavailable: %s' % e)
+            if self.db_params is not None:
+                try:
+                    files = self.connect()._load_checkpoint()
+                    print('checkpoint loaded from database')
+                except Exception as e:
+                    print('database checkpoint unavailable: %s' % e)
+        with self.lock:
+            self.files = files
+        positions = {}
+        for key in files:
+            dev, inode = key.split(':')
+            positions[(int(dev), int(inode))] = files[key]['offset']
+        return positions
+
+    # 记录一次读取，offset为读取后的字节偏移量，返回值为确认函数，日志上传（或写入本地缓存）后调用
+    def track(self, file_key, path, offset):
+        key = '%s:%s' % file_key
+        entry = [offset, 0]
+        with self.lock:
+            self.pending.setdefault(key, []).append(entry)
+
+        def ack():
+            with self.lock:
+                entry[1] = 1
+                pending = self.pending.get(key, [])
+                # 之前的读取都已上传后，才推进检查点
+                while pending and pending[0][1]:
+                    self.files[key] = {'path': path, 'offset': pending.pop(0)[0]}
+                    self.dirty = 1
+                if not pending:
+                    self.pending.pop(key, None)
+        return ack
+
+    # 只保留仍在读取的文件，file_keys为(设备号, inode)集合
+    def retain(self, file_keys):
+        keys = set('%s:%s' % file_key for file_key in file_keys)
+        with self.lock:
+            for key in list(self.files):
+                if key not in keys and key not in self.pending:
+                    del self.files[key]
+                    self.dirty = 1
+
+    # 定时保存检查点
+    def run(self):
+        while 1:
+            time.sleep(self.interval)
+            self.save()
+
+    # 保存检查点，先写临时文件再替换，避免保存中断时损坏检查点
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            files = dict(self.files)
+            self.dirty = 0
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path + '.tmp', 'w') as file:
+                json.dump(files, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            print('save local checkpoint failed: %s' % e)
+        if self.db_params is not None:
+            try:
+                self.connect()._save_checkpoint(files)
+            except Exception as e:
+                print('save database checkpoint failed: %s' % e)
+
+    # 连接数据库
+    def connect(self):
+        local_name, db_user, db_password, db_ip = self.db_params
+        return db_connect.DataBase(local_name, db_user, db_password, db_ip)
@@ -0,0 +1,80 @@
+# coding:utf-8
+
+'''
+日志告警判断类
+
+功能：
+被日志收集程序调用，根据告警规则为日志标定告警级别（0代表正常，1代表警告，2代表故障）
+告警规则在初始化时编译为一个正则表达式，每条日志只需扫描一遍，出现故障关键字后立即停止；与逐个关键字计数的结果相同（关键字重叠时同样能识别）
+'''
+
+import re
+from bisect import bisect_right
+
+
+class LogJudge:
+    # 输入参数为：告警规则（形如{'error': [关键字], 'warn': [关键字]}），是否忽略大小写
+    def __init__(self, judge_rule, ignore_case=1):
+        flags = re.IGNORECASE if ignore_case else 0
+        error_rule = self.build_alternation(judge_rule.get('error', []), ignore_case)
+        warn_rule = self.build_alternation(judge_rule.get('warn', []), ignore_case)
+        # 第一组为故障关键字，第二组为警告关键字
+        self.pattern = re.compile('(%s)|(%s)' % (error_rule, warn_rule), flags)
+
+    # 将关键字列表转为正则表达式的多选分支，忽略大小写时去除重复的关键字
+    @staticmethod
+    def build_alternation(rules, ignore_case):
+        keywords = {}
+        for rule in rules:
+            rule = str(rule)
+            if rule:
+                keywords.setdefault(rule.lower() if ignore_case else rule, rule)
+        if not keywords:
+            return '(?!x)x'  # 不会匹配任何内容
+        # 长关键字在前，避免被其前缀提前匹配
+        return '|'.join(re.escape(rule) for rule in sorted(keywords.values(), key=len, reverse=True))
+
+    # 判断单条日志的告警级别
+    # 警告关键字中可能包含故障关键字（如警告xerr与故障error重叠于xerror），匹配到警告关键字后从其下一个字符继续查找
+    def judge_line(self, line):
+        urgent_class = 0
+        pos = 0
+        while 1:
+            match = self.pattern.search(line, pos)
+            if match is None:
+                return urgent_class
+            # 出现故障关键字，立即停止
+            if match.lastindex == 1:
+                return 2
+            urgent_class = 1
+            pos = match.start() + 1
+
+    # 批量判断日志的告警级别，返回值为与输入等长的告警级别列表
+    # 整批日志拼接后只扫描一遍，某条日志出现故障关键字后直接跳到下一条日志
+    def judge_lines(self, lines):
+        urgent_class_list = [0] * len(lines)
+        if not lines:
+            return urgent_class_list
+        # 每条日志在拼接文本中的起始位置
+        starts = []
+        pos = 0
+        for line in lines:
+            starts.append(pos)
+            pos += len(line) + 1
+        text = '\n'.join(lines)
+
+        pos = 0
+        while 1:
+            match = self.pattern.search(text, pos)
+            if match is None:
+                break
+            seq = bisect_right(starts, match.start()) - 1
+            if match.lastindex == 1:
+                urgent_class_list[seq] = 2
+                if seq + 1 >= len(starts):
+                    break
+                pos = starts[seq + 1]
+            else:
+                urgent_class_list[seq] = 1
+                pos = match.start() + 1
+        return urgent_class_list
@@ -0,0 +1,158 @@
+# coding:utf-8
+
+'''
+日志本地缓存类
+
+功能：
+被日志上传类调用，数据库不可用或上传积压时，将待上传的数据包暂存在本地磁盘，数据库恢复后再批量补传
+1. 缓存按段文件顺序追加写入，每条记录带有长度和crc32校验，损坏的记录会被跳过
+2. 缓存总大小有上限，超过上限时拒绝写入，由调用方阻塞等待
+3. 写入前为每个数据包分配_id，补传中断后重复补传时数据库会以重复键拒绝，不会产生重复数据
+'''
+
+import os
+import zlib
+import struct
+import threading
+import bson
+from bson.objectid import ObjectId
+
+RECORD_HEADER = struct.Struct('>II')  # 记录头：数据长度，crc32校验值
+SEGMENT_SUFFIX = '.spool'
+
+
+class LogSpool:
+    # 输入参数为：缓存目录，单个段文件的大小上限（字节），缓存总大小上限（字节）
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_size=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.segments = []  # 按写入顺序排列的段文件序号
+        self.size = 0  # 缓存总大小
+        self.writer = None  # 正在写入的段文件
+        self.writer_seq = None  # 正在写入的段文件序号
+        self.writer_size = 0  # 正在写入的段文件大小
+        self.read_file = None  # 正在补传的段文件
+        self.read_seq = None  # 正在补传的段文件序号
+
+        # 加载上次运行时遗留的缓存
+        os.makedirs(directory, exist_ok=True)
+        for file_name in os.listdir(directory):
+            if file_name.endswith(SEGMENT_SUFFIX) and file_name[:-len(SEGMENT_SUFFIX)].isdigit():
+                self.segments.append(int(file_name[:-len(SEGMENT_SUFFIX)]))
+                self.size += os.path.getsize(self.segment_path(self.segments[-1]))
+        self.segments.sort()
+        self.next_seq = self.segments[-1] + 1 if self.segments else 0
+        if self.segments:
+            print('spool: %s bytes left from last run' % self.size)
+
+    # 段文件地址
+    def segment_path(self, seq):
+        return os.path.join(self.directory, '%010d%s' % (seq, SEGMENT_SUFFIX))
+
+    # 缓存是否为空
+    def empty(self):
+        return not self.segments
+
+    # 写入数据包，返回值：1 写入成功，0 缓存已满
+    def append(self, col_name, documents):
+        for document in documents:
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+        payload = bson.encode({'col': col_name, 'docs': documents})
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.size + len(record) > self.max_size:
+                return 0
+            if self.writer is None or self.writer_size >= self.segment_size:
+                self.open_segment()
+            self.writer.write(record)
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.writer_size += len(record)
+            self.size += len(record)
+        return 1
+
+    # 新建段文件用于写入
+    def open_segment(self):
+        self.close_segment()
+        self.writer_seq = self.next_seq
+        self.next_seq += 1
+        self.writer = open(self.segment_path(self.writer_seq), 'ab')
+        self.writer_size = 0
+        self.segments.append(self.writer_seq)
+
+    # 关闭正在写入的段文件
+    def close_segment(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.writer_seq = None
+
+    # 按写入顺序补传缓存，handler(表名, 数据包列表)为上传函数，最多补传max_records条记录
+    # handler抛出异常时停止补传，该记录保留在缓存中，异常向上抛出；返回值为补传的数据包数量
+    def replay(self, handler, max_records=10):
+        replayed = 0
+        for _ in range(max_records):
+            with self.lock:
+                record = self.next_record()
+            if record is None:
+                break
+            position, col_name, documents = record
+            handler(col_name, documents)
+            # 上传成功后才越过该记录
+            with self.lock:
+                self.read_file.seek(position)
+            replayed += len(documents)
+        return replayed
+
+    # 读取下一条记录，返回值为(下一条记录的位置, 表名, 数据包列表)，缓存为空时返回None
+    def next_record(self):
+        while self.segments:
+            if self.read_file is None:
+                self.read_seq = self.segments[0]
+                # 补传到了正在写入的段文件，之后的写入改用新的段文件
+                if self.read_seq == self.writer_seq:
+                    self.close_segment()
+                self.read_file = open(self.segment_path(self.read_seq), 'rb')
+            position = self.read_file.tell()
+            header = self.read_file.read(RECORD_HEADER.size)
+            if len(header) == RECORD_HEADER.size:
+                length, checksum = RECORD_HEADER.unpack(header)
+                payload = self.read_file.read(length)
+                if len(payload) == length and zlib.crc32(payload) == checksum:
+                    # 先回到记录开头，上传成功后再越过该记录
+                    next_position = self.read_file.tell()
+                    self.read_file.seek(position)
+                    record = bson.decode(payload)
+                    return next_position, record['col'], record['docs']
+                print('spool: corrupted record in %s at %s, rest of the segment dropped' %
+                      (self.segment_path(self.read_seq), position))
+            # 段文件已补传完（或已损坏），删除
+            self.remove_segment()
+        return None
+
+    # 清空缓存
+    def clear(self):
+        with self.lock:
+            self.close_segment()
+            if self.read_file is not None:
+                self.read_file.close()
+                self.read_file = None
+            for seq in self.segments:
+                os.remove(self.segment_path(seq))
+            self.segments = []
+            self.read_seq = None
+            self.size = 0
+
+    # 删除已补传完的段文件
+    def remove_segment(self):
+        path = self.segment_path(self.read_seq)
+        self.read_file.close()
+        self.read_file = None
+        self.size -= os.path.getsize(path)
+        os.remove(path)
+        self.segments.remove(self.read_seq)
+        self.read_seq = None
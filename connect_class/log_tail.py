@@ -0,0 +1,228 @@
+# coding:utf-8
+
+'''
+日志文件追踪类
+
+功能：
+1. 被日志收集程序调用，按字节偏移量追踪日志文件，每次只读取文件末尾新增的内容
+2. 以(设备号, inode)标识文件，日志轮转（改名、copytruncate、软链接切换）后先读完旧文件再切换到新文件，已读取的内容不会重复读取
+3. 可从检查点恢复各文件的字节偏移量，程序重启后从上次的位置继续读取
+4. 每次最多读取指定字节数，大文件分块读取，内存占用与文件大小无关
+5. 线程安全，不同的日志地址可以在多个线程中并行读取
+'''
+
+import os
+import threading
+
+HEAD_BYTES = 64  # 文件开头用于识别copytruncate的字节数
+
+
+# 单个日志文件的读取状态
+class LogFile:
+    # 输入参数为：日志文件的绝对地址
+    def __init__(self, path):
+        self.path = path
+        self.file = None  # 打开的文件句柄，文件被改名或删除后仍可继续读取
+        self.dev = None  # 文件所在设备号
+        self.inode = None  # 文件inode，与设备号共同标识文件
+        self.offset = 0  # 已处理完毕的字节偏移量
+        self.size = 0  # 上次检查时的文件大小
+        self.remain = b''  # 文件末尾尚未以换行符结束的半行内容
+        self.head = b''  # 文件开头的内容，与当前开头不一致时说明文件被截断后又写入了新内容
+
+        self.pending = None  # 本次读取后、尚未确认的(偏移量, 半行内容)
+        self.lock = threading.Lock()  # 多个日志地址指向同一文件时，保证同一时间只有一个线程读取
+
+    # 打开文件并记录文件标识
+    def open(self):
+        self.file = open(self.path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.dev = stat.st_dev
+        self.inode = stat.st_ino
+
+    # 关闭文件
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # 文件标识
+    @property
+    def key(self):
+        return self.dev, self.inode
+
+    # 读取新增的日志条目，返回值为日志条目列表
+    # 读取后需调用commit确认，未确认时下次仍从原偏移量开始读取
+    # final=1 时表示文件不会再有新内容（已被轮转或删除），末尾的半行也作为一条日志返回
+    # max_bytes 为单次最多读取的字节数，为None时读到文件末尾；超过该长度的单行日志会被拆分
+    def read_new(self, final=0, max_bytes=None):
+        if self.file is None:
+            self.open()
+        stat = os.fstat(self.file.fileno())
+        # 文件被截断（copytruncate），则从头读取
+        # 截断后新写入的内容可能已超过原偏移量，因此同时比较文件开头的内容
+        head = self.read_head(stat.st_size)
+        length = min(len(head), len(self.head))
+        if stat.st_size < self.offset or head[:length] != self.head[:length]:
+            self.reset()
+        if len(head) > len(self.head):
+            self.head = head
+        self.size = stat.st_size
+        # 直接跳转到上次的位置，只读取新增的字节
+        data = b''
+        if stat.st_size > self.offset:
+            length = stat.st_size - self.offset
+            if max_bytes is not None:
+                length = min(length, max_bytes)
+            self.file.seek(self.offset)
+            data = self.file.read(length)
+
+        # 拼接上次残留的半行，最后一段若不以换行结尾则留到下次
+        # final=1 时只有读到文件末尾才将末尾的半行作为一条日志返回，分段读取中途的半行仍留到下次
+        lines = (self.remain + data).split(b'\n')
+        remain = lines.pop()
+        at_end = self.offset + len(data) == stat.st_size
+        if final and at_end and remain or max_bytes is not None and len(remain) >= max_bytes:
+            lines.append(remain)
+            remain = b''
+        self.pending = (self.offset + len(data), remain)
+        return [line.decode('utf-8', errors='ignore') for line in lines]
+
+    # 读取文件开头至多HEAD_BYTES个字节
+    def read_head(self, size):
+        self.file.seek(0)
+        return self.file.read(min(size, HEAD_BYTES))
+
+    # 确认上次读取的内容已处理完毕，更新偏移量
+    def commit(self):
+        if self.pending:
+            self.offset, self.remain = self.pending
+            self.pending = None
+
+    # 上次读取后文件中是否还有未读取的内容
+    def has_more(self):
+        offset = self.pending[0] if self.pending else self.offset
+        return offset < self.size
+
+    # 已处理完毕的完整日志的结束位置（不含末尾的半行），用于保存检查点
+    @property
+    def position(self):
+        return self.offset - len(self.remain)
+
+    # 重置读取状态，下次从头读取
+    def reset(self):
+        self.offset = 0
+        self.remain = b''
+        self.head = b''
+        self.pending = None
+
+
+# 日志文件登记表，以(设备号, inode)为索引，跟踪日志地址与实际文件的对应关系
+class FileRegistry:
+    def __init__(self):
+        self.files = {}  # (设备号, inode) -> LogFile
+        self.paths = {}  # 日志地址 -> 当前正在读取的LogFile
+        self.rotated = {}  # 日志地址 -> 已被轮转或删除、尚未读完的旧LogFile列表
+        self.restored = {}  # 从检查点恢复的(设备号, inode) -> 字节偏移量，文件首次打开时使用
+        self.lock = threading.Lock()  # 保护以上登记信息，读取文件内容时不持有
+
+    # 读取指定日志地址新增的日志条目并确认，max_bytes为单次最多读取的字节数
+    # 返回值为(日志条目列表, 读取的LogFile)
+    # 若文件已被轮转，先返回旧文件剩余的内容，旧文件读完后再读取新文件
+    # 文件不存在且没有待读完的旧文件时，抛出FileNotFoundError
+    def read_chunk(self, path, max_bytes=None):
+        with self.lock:
+            self.follow(path)
+        while 1:
+            with self.lock:
+                rotated = self.rotated.get(path)
+                if rotated:
+                    log_file, final = rotated[0], 1
+                else:
+                    self.rotated.pop(path, None)
+                    log_file, final = self.paths.get(path), 0
+                    if log_file is None:
+                        raise FileNotFoundError(path)
+            with log_file.lock:
+                lines = log_file.read_new(final=final, max_bytes=max_bytes)
+                log_file.commit()
+            # 已轮转的旧文件读完后释放，继续读取下一个文件
+            if final and not lines:
+                with self.lock:
+                    if rotated and rotated[0] is log_file:
+                        rotated.pop(0)
+                    self.release(log_file)
+                continue
+            return lines, log_file
+
+    # 指定日志地址是否还有未读取的内容（包括待读完的旧文件）
+    def has_more(self, path):
+        with self.lock:
+            if self.rotated.get(path):
+                return True
+            log_file = self.paths.get(path)
+        return log_file is not None and log_file.has_more()
+
+    # 从检查点恢复各文件的字节偏移量，positions形如{(设备号, inode): 字节偏移量}
+    def restore(self, positions):
+        with self.lock:
+            self.restored = dict(positions)
+
+    # 当前登记的所有文件标识
+    def keys(self):
+        with self.lock:
+            return list(self.files)
+
+    # 检查日志地址是否指向了新的文件（改名轮转、软链接切换、删除），需持有self.lock
+    def follow(self, path):
+        current = self.paths.get(path)
+        try:
+            stat = os.stat(path)
+            if current is not None and current.key == (stat.st_dev, stat.st_ino):
+                return
+            new = LogFile(path)
+            new.open()
+        except FileNotFoundError:
+            # 文件已被删除，当前文件转为待读完的旧文件
+            if current is not None:
+                self.rotate(path, current)
+            return
+        # 地址指向的文件已改变，旧文件转为待读完的旧文件
+        if current is not None:
+            self.rotate(path, current)
+        # 若该文件已被登记（例如通过其他地址读取过），沿用原有的读取状态，避免重复读取
+        if new.key in self.files:
+            new.close()
+        else:
+            # 检查点中有该文件时，从上次的位置继续读取
+            if new.key in self.restored:
+                new.offset = self.restored.pop(new.key)
+            self.files[new.key] = new
+        self.paths[path] = self.files[new.key]
+
+    # 将日志地址当前的文件转为待读完的旧文件，需持有self.lock
+    def rotate(self, path, log_file):
+        del self.paths[path]
+        print('%s rotated, draining the old file' % path)
+        self.rotated.setdefault(path, []).append(log_file)
+
+    # 移除日志地址
+    def remove(self, path):
+        with self.lock:
+            released = []
+            if path in self.paths:
+                released.append(self.paths.pop(path))
+            released += self.rotated.pop(path, [])
+            for log_file in released:
+                self.release(log_file)
+
+    # 文件不再被任何日志地址引用时，关闭文件并注销，需持有self.lock
+    def release(self, log_file):
+        if log_file in self.paths.values():
+            return
+        for rotated in self.rotated.values():
+            if log_file in rotated:
+                return
+        log_file.close()
+        if self.files.get(log_file.key) is log_file:
+            del self.files[log_file.key]
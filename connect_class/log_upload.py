@@ -0,0 +1,172 @@
+# coding:utf-8
+
+'''
+日志上传类
+
+功能：
+被日志收集程序调用，在后台线程中批量上传日志
+1. 所有日志文件的数据包经有界队列汇总，按表名分组，达到数量或时间阈值后以无序批量写入上传
+2. 上传失败或队列积压时，数据包写入本地缓存（见log_spool），数据库恢复后从缓存批量补传，缓存补传完时标注补传的表及最小的_id（见db_connect._mark_replay）
+3. 未启用本地缓存或缓存已满时，保留数据包并定时重试，此时队列逐渐占满，读取日志的一方会被阻塞，避免内存无限增长
+4. 数据包写入数据库或本地缓存后，调用提交时附带的确认函数（用于推进检查点）
+'''
+
+import time
+import queue
+import threading
+
+# 数据库连接类
+from connect_class import db_connect
+
+
+class LogUploader(threading.Thread):
+    # 初始化参数：数据库名，数据库用户，数据库密码，数据库ip，队列长度，单批上传条数，上传时间间隔（秒），失败重试间隔（秒），
+    # 本地缓存（LogSpool，为None时不使用），队列占满多久后改写本地缓存（秒），是否写入合并表
+    def __init__(self, db_name, db_user, db_password, db_ip, queue_size=1000, batch_size=5000, flush_interval=0.5,
+                 retry_interval=3, spool=None, spool_timeout=1, consolidated=0):
+        threading.Thread.__init__(self, daemon=True)
+        self.params = {}
+        # 数据库参数
+        self.params['db_name'] = db_name
+        self.params['db_ip'] = db_ip
+        self.params['db_user'] = db_user
+        self.params['db_password'] = db_password
+        self.params['consolidated'] = consolidated
+
+        self.queue = queue.Queue(maxsize=queue_size)  # 待上传的(表名, 数据包列表, 确认函数)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.spool = spool
+        self.spool_timeout = spool_timeout
+
+        self.buffer = {}  # 表名 -> 待上传的数据包列表
+        self.buffer_acks = {}  # 表名 -> 待上传数据包的确认函数列表
+        self.buffered = 0  # 待上传的数据包数量
+        self.first_time = 0  # 最早一个待上传数据包的加入时间
+        self.failed = 0  # 上次上传是否失败
+        self.retry_time = 0  # 上传失败后，下次尝试连接数据库的时间
+        self.replayed = {}  # 本轮补传（直到缓存补传完）中各表补传日志的最小_id，尚未标注
+
+    # 提交待上传的数据包，队列已满时改写本地缓存；无法写入缓存时阻塞，直到上传线程取走数据
+    # ack为确认函数，数据包写入数据库或本地缓存后调用，可为None
+    def put(self, col_name, documents, ack=None):
+        if not documents:
+            if ack is not None:
+                ack()
+            return
+        if self.spool is not None:
+            try:
+                self.queue.put((col_name, documents, ack), timeout=self.spool_timeout)
+                return
+            except queue.Full:
+                if self.spool.append(col_name, documents):
+                    if ack is not None:
+                        ack()
+                    return
+        self.queue.put((col_name, documents, ack))
+
+    # 上传主函数
+    def run(self):
+        while 1:
+            # 上传失败且无法写入本地缓存时，不再从队列取数据，等待后重试
+            if self.failed and self.buffered:
+                time.sleep(max(self.retry_time - time.time(), 0))
+                self.flush()
+                continue
+            # 等待新的数据包，有待上传数据时最多等到上传时间
+            timeout = None
+            if self.buffered:
+                timeout = max(self.flush_interval - (time.time() - self.first_time), 0)
+            # 本地缓存中有积压数据时，数据库可用则立即补传，否则等到重试时间
+            if self.spool is not None and not self.spool.empty():
+                drain_wait = max(self.retry_time - time.time(), 0) if self.failed else 0
+                timeout = drain_wait if timeout is None else min(timeout, drain_wait)
+            try:
+                col_name, documents, ack = self.queue.get(timeout=timeout)
+                if not self.buffered:
+                    self.first_time = time.time()
+                self.buffer.setdefault(col_name, []).extend(documents)
+                if ack is not None:
+                    self.buffer_acks.setdefault(col_name, []).append(ack)
+                self.buffered += len(documents)
+            except queue.Empty:
+                pass
+            # 达到数量或时间阈值后上传
+            if self.buffered >= self.batch_size or \
+                    (self.buffered and time.time() - self.first_time >= self.flush_interval):
+                self.flush()
+            elif self.spool is not None and (not self.spool.empty() or self.replayed) and \
+                    (not self.failed or time.time() >= self.retry_time):
+                self.drain()
+
+    # 按表名批量上传所有待上传的数据包
+    def flush(self):
+        # 数据库不可用，未到重试时间时直接写入本地缓存
+        if self.failed and time.time() < self.retry_time:
+            self.spool_buffer()
+            return
+        conn = db_connect.DataBase(self.params['db_name'], self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'], 0, consolidated=self.params['consolidated'])
+        time_start = time.time()
+        uploaded = 0
+        for col_name in list(self.buffer):
+            documents = self.buffer[col_name]
+            try:
+                conn._insert_documents(col_name, documents)
+            except Exception as e:
+                self.fail(col_name, e)
+                self.spool_buffer()
+                return
+            self.release(col_name)
+            uploaded += len(documents)
+        self.failed = 0
+        print('%s   |   %s lines inserted, %s sec used' %
+              (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), uploaded, time.time() - time_start))
+
+    # 从本地缓存补传数据，缓存补传完时标注本轮补传的表
+    def drain(self):
+        conn = db_connect.DataBase(self.params['db_name'], self.params['db_user'], self.params['db_password'],
+                                   self.params['db_ip'], 0, consolidated=self.params['consolidated'])
+        time_start = time.time()
+
+        def handler(col_name, documents):
+            conn._insert_documents(col_name, documents)
+            min_id = min(document['_id'] for document in documents)
+            self.replayed[col_name] = min(self.replayed.get(col_name, min_id), min_id)
+        try:
+            uploaded = self.spool.replay(handler)
+            # 日志处理程序据此重新查询补传的日志（其_id可能小于已读取的高水位），每轮补传只标注一次
+            if self.spool.empty() and self.replayed:
+                conn._mark_replay(self.replayed)
+                self.replayed = {}
+        except Exception as e:
+            self.fail('spool', e)
+            return
+        self.failed = 0
+        print('%s   |   %s spooled lines inserted, %s sec used, %s bytes left in spool' %
+              (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), uploaded, time.time() - time_start,
+               self.spool.size))
+
+    # 标记上传失败
+    def fail(self, col_name, e):
+        print('upload to %s failed, retry in %s sec: %s' % (col_name, self.retry_interval, e))
+        self.failed = 1
+        self.retry_time = time.time() + self.retry_interval
+
+    # 将待上传的数据包写入本地缓存，缓存已满的部分保留在内存中
+    def spool_buffer(self):
+        if self.spool is None:
+            return
+        for col_name in list(self.buffer):
+            documents = self.buffer[col_name]
+            if not self.spool.append(col_name, documents):
+                print('spool is full (%s bytes), waiting for the database' % self.spool.size)
+                return
+            self.release(col_name)
+
+    # 表中的数据包已写入数据库或本地缓存，移出待上传数据并确认
+    def release(self, col_name):
+        self.buffered -= len(self.buffer.pop(col_name))
+        for ack in self.buffer_acks.pop(col_name, []):
+            ack()
@@ -0,0 +1,181 @@
+# coding:utf-8
+
+'''
+日志变动监听类
+
+功能：
+1. 被日志收集程序调用，通过Linux inotify监听日志文件的新增、追加写入和删除，有变动时立即返回
+2. 无法使用inotify时（非Linux系统、监听数量达到上限等），退化为定时轮询
+'''
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify事件类型，见 /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+FILE_MASK = IN_MODIFY | IN_DELETE_SELF | IN_MOVE_SELF
+DIRECTORY_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len
+
+
+class LogWatcher:
+    # 输入参数为：全量检查的时间间隔（秒），即使inotify正常工作，也定期全量检查一次以防漏掉事件
+    def __init__(self, full_interval=60):
+        self.full_interval = full_interval
+        self.last_full = 0  # 首次等待时立即全量检查，读取启动前已有的日志
+
+        self.fd = -1  # inotify文件描述符，-1表示inotify不可用
+        self.libc = None
+        self.wd_paths = {}  # 监听描述符 -> 日志地址集合（软链接指向同一文件时共用一个描述符）
+        self.path_wd = {}  # 日志地址 -> 监听描述符
+        self.directories = {}  # 监听描述符 -> 目录地址
+        self.polled = set()  # 无法监听、需要定时轮询的日志地址
+        self.recheck = set()  # 还有未读完的内容、需要立即重新检查的日志地址
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self.libc = libc
+            self.fd = fd
+        except (OSError, AttributeError) as e:
+            print('inotify unavailable, falling back to polling: %s' % e)
+
+    # 是否正在使用inotify
+    @property
+    def enabled(self):
+        return self.fd >= 0
+
+    # 添加inotify监听，返回监听描述符，失败时返回-1
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err != errno.ENOENT:
+                print('inotify_add_watch %s failed: %s' % (path, os.strerror(err)))
+        return wd
+
+    # 监听目录中日志文件的新增和删除
+    def watch_directory(self, directory):
+        if not self.enabled:
+            return
+        wd = self.add_watch(directory, DIRECTORY_MASK)
+        if wd >= 0:
+            self.directories[wd] = directory
+
+    # 监听日志文件的追加写入、改名和删除，无法监听时改为定时轮询
+    def watch(self, path):
+        if not self.enabled:
+            return
+        self.unwatch(path)
+        wd = self.add_watch(path, FILE_MASK)
+        if wd < 0:
+            self.polled.add(path)
+            return
+        self.polled.discard(path)
+        self.path_wd[path] = wd
+        self.wd_paths.setdefault(wd, set()).add(path)
+
+    # 取消对日志文件的监听
+    def unwatch(self, path):
+        self.polled.discard(path)
+        self.recheck.discard(path)
+        wd = self.path_wd.pop(path, None)
+        if wd is None:
+            return
+        paths = self.wd_paths.get(wd, set())
+        paths.discard(path)
+        if not paths:
+            self.wd_paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    # 等待日志变动，返回值为发生变动的日志地址集合
+    # 返回None时表示需要全量检查（inotify不可用、事件队列溢出、目录内容变动或到达全量检查时间）
+    def wait(self, timeout):
+        # 有需要立即重新检查的日志时不等待
+        recheck = self.recheck
+        self.recheck = set()
+        if not self.enabled:
+            if recheck:
+                return recheck
+            time.sleep(timeout)
+            return None
+        # 到达全量检查时间
+        full_remain = self.full_interval - (time.time() - self.last_full)
+        if full_remain <= 0:
+            self.last_full = time.time()
+            return None
+        # 有需要轮询的日志时，最多等待timeout秒
+        if recheck:
+            full_remain = 0
+        elif self.polled:
+            full_remain = min(full_remain, timeout)
+        readable, _, _ = select.select([self.fd], [], [], full_remain)
+        if not readable:
+            return self.timeout_paths() | recheck
+        changed = self.read_events()
+        if changed is None:
+            return None
+        return changed | recheck
+
+    # 超时时需要检查的日志地址，同时尝试重新监听之前无法监听的日志
+    def timeout_paths(self):
+        changed = set(self.polled)
+        for path in list(self.polled):
+            self.watch(path)
+        return changed
+
+    # 读取并解析inotify事件
+    def read_events(self):
+        data = b''
+        while 1:
+            try:
+                data += os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+        changed = set()
+        rewatch = set()
+        full = 0
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size + name_len
+            # 事件队列溢出，可能漏掉了事件
+            if mask & IN_Q_OVERFLOW:
+                full = 1
+            # 目录中有日志文件新增或删除
+            elif wd in self.directories:
+                full = 1
+            elif mask & IN_IGNORED:
+                for path in self.wd_paths.pop(wd, set()):
+                    self.path_wd.pop(path, None)
+                    rewatch.add(path)
+            elif wd in self.wd_paths:
+                changed |= self.wd_paths[wd]
+                # 文件被改名或删除（日志轮转），需要重新监听该地址上的新文件
+                if mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                    rewatch |= self.wd_paths[wd]
+        for path in rewatch:
+            self.watch(path)
+        changed |= rewatch
+        if full:
+            self.last_full = time.time()
+            self.timeout_paths()
+            return None
+        return changed
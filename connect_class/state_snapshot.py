@@ -0,0 +1,115 @@
+# coding:utf-8
+
+'''
+内存状态快照类
+
+功能：
+被日志处理程序调用，定期将内存中的数据和各表的高水位保存为本地的二进制快照，重启后从快照恢复，不必从头查询数据库
+1. 快照由文件头、BSON编码的元数据（带crc32校验）和按8字节对齐的numpy数组（各自带crc32校验）组成
+2. 加载时元数据整体读入，数组以写时复制方式内存映射，校验后使用
+3. 先写临时文件再替换，保存中断时不会损坏上一次的快照
+4. 多进程部署时，刷新进程将发布的数据写为快照，各接口进程在快照文件变动时重新映射（见SnapshotReader）
+'''
+
+import os
+import mmap
+import zlib
+import struct
+import threading
+import bson
+from bson.errors import BSONError
+import numpy as np
+
+SNAPSHOT_MAGIC = b'CLSNAP02'
+SNAPSHOT_HEADER = struct.Struct('>8sQI')  # 文件头：标识，元数据长度，元数据crc32校验值
+ALIGNMENT = 8
+
+
+class StateSnapshot:
+    # 输入参数为：快照文件地址，保存间隔（秒）
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.last_save = 0  # 上次保存的时间
+
+    # 保存快照，meta为可BSON编码的字典，arrays为{数组名: 一维numpy数组}
+    def save(self, meta, arrays):
+        arrays = {name: np.ascontiguousarray(arrays[name]) for name in arrays}
+        layout = {}
+        offset = 0
+        for name in arrays:
+            offset += -offset % ALIGNMENT
+            layout[name] = {'offset': offset, 'dtype': arrays[name].dtype.str, 'length': len(arrays[name]),
+                            'crc32': zlib.crc32(arrays[name])}
+            offset += arrays[name].nbytes
+        payload = bson.encode({'meta': meta, 'arrays': layout})
+        start = SNAPSHOT_HEADER.size + len(payload)
+        start += -start % ALIGNMENT
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # 临时文件名区分进程和线程，多个进程同时保存同一快照时互不影响
+        temp_path = '%s.%s-%s.tmp' % (self.path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(payload), zlib.crc32(payload)))
+            file.write(payload)
+            for name in arrays:
+                file.seek(start + layout[name]['offset'])
+                file.write(arrays[name].tobytes())
+            file.truncate(start + offset)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    # 加载快照，返回值为(meta, {数组名: numpy数组})，快照不存在、已损坏或格式不符时返回None
+    # 整个快照文件只映射一次，各数组为映射上的视图
+    def load(self):
+        try:
+            with open(self.path, 'rb') as file:
+                magic, length, checksum = SNAPSHOT_HEADER.unpack(file.read(SNAPSHOT_HEADER.size))
+                payload = file.read(length)
+                if magic != SNAPSHOT_MAGIC or len(payload) != length or zlib.crc32(payload) != checksum:
+                    raise ValueError('corrupted snapshot header')
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+            record = bson.decode(payload)
+            start = SNAPSHOT_HEADER.size + length
+            start += -start % ALIGNMENT
+            arrays = {}
+            for name in record['arrays']:
+                layout = record['arrays'][name]
+                dtype = np.dtype(layout['dtype'])
+                if start + layout['offset'] + dtype.itemsize * layout['length'] > len(mapped):
+                    raise ValueError('snapshot truncated at %s' % name)
+                arrays[name] = np.frombuffer(mapped, dtype=dtype, count=layout['length'],
+                                             offset=start + layout['offset'])
+                if zlib.crc32(arrays[name]) != layout['crc32']:
+                    raise ValueError('checksum mismatch at %s' % name)
+        except (OSError, KeyError, ValueError, struct.error, BSONError) as e:
+            print('snapshot %s unavailable: %s' % (self.path, e))
+            return None
+        return record['meta'], arrays
+
+    # 是否到达保存时间
+    def due(self, now):
+        return now - self.last_save >= self.interval
+
+
+# 快照读取类，快照文件被替换（文件标识、修改时间或大小变化）时重新加载，供多个线程共用
+class SnapshotReader:
+    # 输入参数为：快照文件地址
+    def __init__(self, path):
+        self.snapshot = StateSnapshot(path)
+        self.key = None  # 已加载的快照文件的(inode, 修改时间, 大小)
+        self.lock = threading.Lock()
+
+    # 快照文件有变动时重新加载，返回值为(meta, {数组名: numpy数组})，没有变动或无法加载时返回None
+    def reload(self):
+        with self.lock:
+            try:
+                stat = os.stat(self.snapshot.path)
+            except OSError:
+                return None
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if key == self.key:
+                return None
+            # 无法加载时同样记录，快照再次变动前不重复尝试
+            self.key = key
+            return self.snapshot.load()